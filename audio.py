@@ -1,22 +1,43 @@
+import time
+import numpy as np
 import pygame
+from collections import deque
+from beatmap_reader import HitObjectType
 
 
 class AudioManager:
-    def __init__(self, volume=0.25, is_disabled=False, channel_amount=32):
+    @staticmethod
+    def init_mixer(channel_amount=32):
+        """
+        Called once from the main thread before any AudioManager is made.
+        """
         pygame.mixer.init()
-
-        self.channel_amount = channel_amount
-
         # for overlapping sounds, channel 0 is reserved for beatmap music
         pygame.mixer.set_num_channels(channel_amount)
+        pygame.mixer.set_reserved(1)
+
+    def __init__(self, volume=0.25, is_disabled=False, channel_amount=32):
+        self.channel_amount = channel_amount
 
         self.time_after_last_modified_volume = -750
         self.is_disabled = is_disabled
         self.volume = volume if not is_disabled else 0
 
         self.beatmap_audio_playing = False
-
-        pygame.mixer.music.set_volume(self.volume)
+        # Where in the beatmap audio playback was started from in ms
+        self.start_offset = 0
+        self.sounds = {}
+        self.samples = SampleBank(self)
+        # The beatmap audio decoded by a PCMCache, played on channel 0 instead of streaming it once it's ready
+        self.pcm = None
+        # When and from where in ms the chunk playing on channel 0 started, 0 if it isn't playing
+        self.pcm_started = 0
+        self.pcm_offset = 0
+        # Frame the next chunk starts at, where the queued chunk starts in ms (None if nothing is queued)
+        # and when update() last checked on the queue
+        self.pcm_frame = 0
+        self.pcm_queued = None
+        self.pcm_checked = 0
 
     def set_volume(self, new_volume):
         if self.is_disabled or self.volume == max(0, min(1, new_volume)):
@@ -24,6 +45,7 @@ class AudioManager:
         self.volume = max(0, min(1, new_volume))
         self.time_after_last_modified_volume = pygame.time.get_ticks()
         pygame.mixer.music.set_volume(new_volume)
+        pygame.mixer.Channel(0).set_volume(self.volume)
 
     def increase_volume(self, channel=0, event=None):
         self.set_volume(self.volume+0.01)
@@ -31,38 +53,271 @@ class AudioManager:
     def decrease_volume(self, channel=0, event=None):
         self.set_volume(self.volume-0.01)
 
-    def load_audio(self, pathto, is_beatmap_audio=False, channel=0):
+    def load_audio(self, pathto, is_beatmap_audio=False, channel=None):
+        """
+        Other audio than the beatmap's is played on `channel`, or on one taken from the channel pool.
+        """
         if self.is_disabled:
             return
         if is_beatmap_audio:
-            pygame.mixer.music.load(pathto)
-        else:
-            pygame.mixer.Channel(1).load(pathto)
-        return channel if not is_beatmap_audio else 0
+            if not self.has_pcm:
+                pygame.mixer.music.load(pathto)
+            return 0
+        if channel is None:
+            channel = self.samples.get_channel(SampleBank.PRIORITIES["other"])
+            if channel is None:
+                return
+        self.sounds[channel] = pygame.mixer.Sound(pathto)
+        return channel
 
     def play_audio(self, offset=0, channel=0):
         if self.is_disabled:
             return
         if channel == 0:
-            pygame.mixer.music.play()
-            pygame.mixer.music.set_pos(offset / 1000)
+            if self.has_pcm:
+                # Streaming stops if the decoded audio got ready while it was playing
+                pygame.mixer.music.stop()
+                self.play_pcm(offset)
+            else:
+                pygame.mixer.music.set_volume(self.volume)
+                pygame.mixer.music.play()
+                pygame.mixer.music.set_pos(offset / 1000)
+                self.pcm_started = 0
+            self.start_offset = offset
             self.beatmap_audio_playing = True
-        else:
-            pygame.mixer.Channel(channel).play()
+        elif channel in self.sounds:
+            pygame.mixer.Channel(channel).set_volume(self.volume)
+            pygame.mixer.Channel(channel).play(self.sounds[channel])
+
+    def play_pcm(self, offset):
+        pcm = self.pcm.result()
+        frame = pcm.get_frame(offset)
+        chunk = pcm.get_chunk(frame)
+        if chunk is None:
+            self.pcm_started = 0
+            return
+        sound, self.pcm_frame = chunk
+        channel = pygame.mixer.Channel(0)
+        channel.set_volume(self.volume)
+        channel.play(sound)
+        self.pcm_started = self.pcm_checked = time.perf_counter()
+        self.pcm_offset = frame / pcm.frequency * 1000
+        self.pcm_queued = None
+        self.update()
+
+    def update(self):
+        """
+        Keep the next chunk of the decoded beatmap audio queued behind the one playing, called every frame.
+        """
+        if not self.pcm_started:
+            return
+        pcm, channel = self.pcm.result(), pygame.mixer.Channel(0)
+        now = time.perf_counter()
+        if not channel.get_busy():
+            # Both chunks ran out, like after a long stall, playback continues from where it should be
+            return self.play_pcm(self.pcm_offset + (now - self.pcm_started) * 1000)
+        if self.pcm_queued is not None and channel.get_queue() is None:
+            # The mixer started the queued chunk since the last check. It should've started when the one before
+            # ended by the clock, if that's outside of that window the clock is off and gets moved
+            expected = self.pcm_started + (self.pcm_queued - self.pcm_offset) / 1000
+            self.pcm_started = min(max(expected, self.pcm_checked), now)
+            self.pcm_offset, self.pcm_queued = self.pcm_queued, None
+        self.pcm_checked = now
+        if self.pcm_queued is None:
+            chunk = pcm.get_chunk(self.pcm_frame)
+            if chunk is not None:
+                self.pcm_queued = self.pcm_frame / pcm.frequency * 1000
+                sound, self.pcm_frame = chunk
+                channel.queue(sound)
+
+    @property
+    def has_pcm(self):
+        """
+        Whether the decoded beatmap audio is ready.
+        """
+        return self.pcm is not None and self.pcm.done() and self.pcm.exception() is None
+
+    def seek(self, offset):
+        """
+        Continue the beatmap audio from `offset` ms, which is sample accurate once the decoded audio is ready.
+        """
+        if self.is_disabled or not self.beatmap_audio_playing:
+            return
+        if self.has_pcm:
+            return self.play_audio(offset)
+        pygame.mixer.music.set_pos(offset / 1000)
+        # get_pos keeps counting from when playing started
+        self.start_offset = offset - pygame.mixer.music.get_pos()
+
+    def get_position(self):
+        """
+        Position of the beatmap audio in ms as the mixer reports it, or None if it isn't playing.
+        """
+        if self.is_disabled or not self.beatmap_audio_playing:
+            return
+        if self.pcm_started:
+            # Channels don't report a position, so it's taken from when the mixer started the playing chunk
+            # (see update()) and moves on by the clock in between
+            if not pygame.mixer.Channel(0).get_busy():
+                return
+            return self.pcm_offset + (time.perf_counter() - self.pcm_started) * 1000
+        position = pygame.mixer.music.get_pos()
+        if position < 0:
+            return
+        return self.start_offset + position
 
     def stop_audio(self, channel=0):
         if self.is_disabled:
             return
         if channel == 0:
             pygame.mixer.music.stop()
+            pygame.mixer.Channel(0).stop()
+            self.pcm_started = 0
             self.beatmap_audio_playing = False
         else:
             pygame.mixer.Channel(channel).stop()
 
+    def close(self):
+        """
+        Stop the beatmap audio and unmap the decoded audio, once it's done decoding.
+        """
+        self.stop_audio()
+        if self.pcm is not None:
+            self.pcm.add_done_callback(close_pcm)
+
     def load_and_play_audio(self, pathto, offset=0, is_beatmap_audio=False):
         if self.is_disabled or (is_beatmap_audio and self.beatmap_audio_playing):
             return
         if is_beatmap_audio:
             self.beatmap_audio_playing = True
         channel = self.load_audio(pathto, is_beatmap_audio=is_beatmap_audio)
-        self.play_audio(offset=offset, channel=channel)
+        if channel is not None:
+            self.play_audio(offset=offset, channel=channel)
+
+
+def close_pcm(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+class SampleBank:
+    """
+    Hitsounds decoded into Sounds once when a beatmap is loaded, played when playback passes the times
+    of the hit objects. They're played on the channels after channel 0, when all of them are busy the one
+    playing the least important and oldest sound is taken over, unless everything playing is more important.
+    How late sounds are triggered and how often channels run out is kept for measuring.
+    """
+
+    SAMPLE_SETS = ("normal", "soft", "drum")
+    # Additions by their bit in a hit object's hitsound, the normal sound always plays
+    ADDITIONS = ("hitwhistle", "hitfinish", "hitclap")
+    PRIORITIES = {"hitnormal": 0, "hitwhistle": 1, "hitclap": 2, "hitfinish": 3, "other": 3}
+    EXTENSIONS = ("wav", "ogg", "mp3")
+    # Sounds that should've played longer ago than this in ms are skipped, like after seeking
+    MAX_LATE = 100
+
+    def __init__(self, audio_manager, history=600):
+        self.audio_manager = audio_manager
+        self.sounds = {}
+        self.channels = []
+        # (priority, start time) of what every channel is playing
+        self.voices = {}
+        self.times = np.empty(0, dtype=np.float64)
+        self.hitsounds = np.empty(0, dtype=np.int8)
+        self.last_offset = -np.inf
+        self.latencies = deque(maxlen=history)
+        self.stolen = 0
+        self.dropped = 0
+
+    def load(self, sample_set, *indexes):
+        """
+        Decode the hitsounds of a sample set, the mixer has to be initialized. `indexes` map lowercase file names to paths
+        (see BaseManager.index_files), the first one that has a sound is used, so pass the beatmap's first.
+        """
+        if self.audio_manager.is_disabled:
+            return
+        sample_set = sample_set.lower() if sample_set.lower() in self.SAMPLE_SETS else "normal"
+        self.channels = [pygame.mixer.Channel(i) for i in range(1, self.audio_manager.channel_amount)]
+        self.sounds = {}
+        for name in ("hitnormal",) + self.ADDITIONS:
+            for index in indexes:
+                file = next(filter(None, (index.get(f"{sample_set}-{name}.{ext}") for ext in self.EXTENSIONS)), None)
+                if file is not None:
+                    self.sounds[name] = pygame.mixer.Sound(file)
+                    break
+
+    def schedule(self, hit_objects):
+        """
+        Sounds play at the start of circles, at every edge of sliders and at the end of spinners.
+        """
+        events = []
+        for hit_object in hit_objects:
+            hitsound = int(hit_object.hit_sound)
+            if hit_object.type == HitObjectType.SPINNER:
+                events.append((hit_object.end_time, hitsound))
+            elif hit_object.type == HitObjectType.SLIDER:
+                slides = hit_object.slides
+                duration = (hit_object.end_time - hit_object.time) / slides
+                events += [(hit_object.time + duration * i, hitsound) for i in range(slides + 1)]
+            else:
+                events.append((hit_object.time, hitsound))
+        events.sort(key=lambda event: event[0])
+        self.times = np.array([event[0] for event in events], dtype=np.float64)
+        self.hitsounds = np.array([event[1] for event in events], dtype=np.int8)
+        self.last_offset = -np.inf
+
+    def update(self, offset):
+        if not self.sounds:
+            return
+        # Seeking back plays the sounds from there again
+        last_offset = min(self.last_offset, offset)
+        start = int(np.searchsorted(self.times, last_offset, "right"))
+        end = int(np.searchsorted(self.times, offset, "right"))
+        self.last_offset = offset
+        for i in range(start, end):
+            late = offset - self.times[i]
+            if late <= self.MAX_LATE:
+                self.trigger(int(self.hitsounds[i]), late)
+
+    def trigger(self, hitsound, late=0):
+        for bit, name in enumerate(("hitnormal",) + self.ADDITIONS):
+            if bit != 0 and not hitsound >> bit & 1 or name not in self.sounds:
+                continue
+            start = time.perf_counter()
+            channel = self.get_channel(self.PRIORITIES[name])
+            if channel is None:
+                continue
+            channel = self.channels[channel - 1]
+            channel.set_volume(self.audio_manager.volume)
+            channel.play(self.sounds[name])
+            self.latencies.append(late + (time.perf_counter() - start) * 1000)
+
+    def get_channel(self, priority):
+        """
+        Number of a free channel, or of the one that's best to stop for a sound of this priority.
+        """
+        if not self.channels:
+            self.channels = [pygame.mixer.Channel(i) for i in range(1, self.audio_manager.channel_amount)]
+        now = time.perf_counter()
+        victim = None
+        for number, channel in enumerate(self.channels, 1):
+            if not channel.get_busy():
+                self.voices[number] = (priority, now)
+                return number
+            if victim is None or self.voices.get(number, (0, 0)) < self.voices.get(victim, (0, 0)):
+                victim = number
+        if victim is None or self.voices.get(victim, (0, 0))[0] > priority:
+            self.dropped += 1
+            return
+        self.stolen += 1
+        self.channels[victim - 1].stop()
+        self.voices[victim] = (priority, now)
+        return victim
+
+    def get_stats(self):
+        """
+        (mean, max) ms sounds were triggered after their time, how many channels were taken over
+        and how many sounds didn't play because all channels were playing something more important.
+        """
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return float(latencies.mean()), float(latencies.max()), self.stolen, self.dropped
@@ -0,0 +1,89 @@
+"""
+Round-trip throughput of the compiled Cache codec on a synthetic library index.
+
+    python benchmarks/cache_roundtrip.py [--sets 20000] [--difficulties 5]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import OsuCache, BeatmapsetCache, BeatmapCache  # noqa: E402
+
+
+def make_cache(sets, difficulties):
+    cache = OsuCache()
+    cache.version = OsuCache.VERSION
+    cache.songs_path = "/songs"
+    cache.beatmapsets = []
+    for i in range(sets):
+        beatmapset = BeatmapsetCache()
+        beatmapset.directory = f"{i} Artist {i} - Title {i}"
+        beatmapset.mtime = 1600000000.0 + i
+        beatmapset.beatmaps = []
+        for j in range(difficulties):
+            beatmap = BeatmapCache()
+            beatmap.filename = f"Artist {i} - Title {i} (Mapper) [Difficulty {j}].osu"
+            beatmap.mtime = 1600000000.0 + i
+            beatmap.size = 20000 + j
+            beatmap.audio_file = "audio.mp3"
+            beatmap.artist = f"Artist {i}"
+            beatmap.title = f"Title {i}"
+            beatmap.creator = "Mapper"
+            beatmap.version = f"Difficulty {j}"
+            beatmap.source = ""
+            beatmap.tags = "some tags for the search index"
+            beatmap.beatmap_id = i * difficulties + j
+            beatmap.beatmapset_id = i
+            beatmap.approach_rate = 9.0
+            beatmap.circle_size = 4.0
+            beatmap.overall_difficulty = 8.0
+            beatmap.hp_drain_rate = 5.0
+            beatmap.length = 180000
+            beatmapset.beatmaps.append(beatmap)
+        cache.beatmapsets.append(beatmapset)
+    return cache
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cache codec round-trip benchmark")
+    parser.add_argument("--sets", type=int, default=20000)
+    parser.add_argument("--difficulties", type=int, default=5)
+    args = parser.parse_args()
+
+    cache = make_cache(args.sets, args.difficulties)
+    records = args.sets * (args.difficulties + 1)
+    OsuCache.get_codec()  # Compile outside the measurements
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, "library.db")
+        _, write_time = timed(lambda: cache.to_file(cache_path))
+        size = os.path.getsize(cache_path) / 1024 / 1024
+
+        lazy, lazy_time = timed(lambda: OsuCache.from_path(cache_path))
+        eager, eager_time = timed(lambda: OsuCache.from_data(open(cache_path, "rb").read()))
+
+        last = cache.beatmapsets[-1].beatmaps[-1]
+        for loaded in (lazy, eager):
+            loaded_last = loaded.beatmapsets[-1].beatmaps[-1]
+            assert all(getattr(loaded_last, attr) == getattr(last, attr) for attr in BeatmapCache.data), \
+                "Round trip changed the data"
+        del lazy, eager, loaded, loaded_last
+
+    print(f"{records} records, {size:.1f} MiB")
+    for name, elapsed in (("write", write_time), ("read (mmap, lazy strings)", lazy_time),
+                          ("read (bytes, eager strings)", eager_time)):
+        print(f"{name:>28}: {elapsed*1000:8.1f} ms  {size/elapsed:7.1f} MiB/s  {records/elapsed:10.0f} records/s")
+
+
+if __name__ == "__main__":
+    main()
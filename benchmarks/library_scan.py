@@ -0,0 +1,104 @@
+"""
+Time and memory of scanning a synthetic songs folder into the library index, next to fully parsing
+a sample of the same beatmaps the way they're parsed for playing.
+
+    python benchmarks/library_scan.py [--sets 1000] [--difficulties 5] [--objects 800] [--full-sample 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from beatmap_reader import Beatmap  # noqa: E402
+from database import OsuCache  # noqa: E402
+
+
+def write_beatmap(beatmap_path, i, j, objects):
+    hit_objects = []
+    for k in range(objects):
+        x, y, t = k * 67 % 512, k * 41 % 384, 1000 + k * 300
+        if k % 3 == 0:
+            hit_objects.append(f"{x},{y},{t},2,0,B|{(x + 100) % 512}:{y}|{(x + 100) % 512}:{(y + 80) % 384},1,140")
+        else:
+            hit_objects.append(f"{x},{y},{t},1,0,0:0:0:0:")
+    with open(beatmap_path, "w") as f:
+        f.write(f"""osu file format v14
+
+[General]
+AudioFilename: audio.mp3
+Mode: 0
+
+[Metadata]
+Title:Title {i}
+Artist:Artist {i}
+Creator:Mapper
+Version:Difficulty {j}
+Source:
+Tags:some tags for the search index
+BeatmapID:{i * 10 + j}
+BeatmapSetID:{i}
+
+[Difficulty]
+HPDrainRate:5
+CircleSize:4
+OverallDifficulty:8
+ApproachRate:9
+SliderMultiplier:1.4
+SliderTickRate:1
+
+[TimingPoints]
+1000,300,4,2,0,50,1,0
+60000,-75,4,2,0,50,0,0
+
+[HitObjects]
+""" + "\n".join(hit_objects) + "\n")
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Library scan benchmark")
+    parser.add_argument("--sets", type=int, default=1000)
+    parser.add_argument("--difficulties", type=int, default=5)
+    parser.add_argument("--objects", type=int, default=800)
+    parser.add_argument("--full-sample", type=int, default=200, help="beatmaps to fully parse for comparison")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as songs_path:
+        paths = []
+        for i in range(args.sets):
+            directory = os.path.join(songs_path, f"{i} Artist {i} - Title {i}")
+            os.mkdir(directory)
+            for j in range(args.difficulties):
+                paths.append(os.path.join(directory, f"Artist {i} - Title {i} (Mapper) [Difficulty {j}].osu"))
+                write_beatmap(paths[-1], i, j, args.objects)
+        size = sum(os.path.getsize(beatmap_path) for beatmap_path in paths) / 1024 / 1024
+
+        cache = OsuCache()
+        cache.version = OsuCache.VERSION
+        cache.songs_path = songs_path
+        cache.beatmapsets = []
+        tracemalloc.start()
+        _, scan_time = timed(cache.update)
+        resident, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        sample = paths[:args.full_sample]
+        _, full_time = timed(lambda: [Beatmap.from_path(beatmap_path).load() for beatmap_path in sample])
+
+    print(f"{len(paths)} beatmaps, {size:.1f} MiB of .osu files")
+    print(f"{'header scan':>24}: {scan_time*1000:8.1f} ms  {len(paths)/scan_time:8.0f} beatmaps/s,"
+          f" {resident/1024/1024:.1f} MiB kept, {peak/1024/1024:.1f} MiB peak")
+    print(f"{'full parse (sample)':>24}: {full_time*1000:8.1f} ms  {len(sample)/full_time:8.0f} beatmaps/s")
+
+
+if __name__ == "__main__":
+    main()
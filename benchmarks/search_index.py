@@ -0,0 +1,69 @@
+"""
+Time song select's search index takes per keystroke on a synthetic library.
+
+    python benchmarks/search_index.py [--sets 20000] [--difficulties 5]
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import SearchIndex  # noqa: E402
+from cache_roundtrip import make_cache, timed  # noqa: E402
+
+WORDS = ("love", "night", "dream", "star", "light", "heart", "world", "fire", "sky", "rain", "snow", "time",
+         "rave", "party", "sweets", "kawaii", "collab", "insane", "hard", "normal", "extra", "expert", "anime")
+QUERIES = ("sweets rave", "love ar>9", "artist 1234", "dream cs<=4 length>60", "kawaii collab stars>5",
+           "title 99 difficulty 3", "zzz")
+
+
+def randomize(cache, rng):
+    for beatmapset in cache.beatmapsets:
+        title = " ".join(rng.choice(WORDS) for _ in range(3))
+        for beatmap in beatmapset.beatmaps:
+            beatmap.title = f"{title} {beatmap.title}"
+            beatmap.tags = " ".join(rng.choice(WORDS) for _ in range(6))
+            beatmap.approach_rate = rng.randint(0, 100) / 10
+            beatmap.circle_size = rng.randint(20, 70) / 10
+            beatmap.length = rng.randint(30000, 600000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Song select search benchmark")
+    parser.add_argument("--sets", type=int, default=20000)
+    parser.add_argument("--difficulties", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cache = make_cache(args.sets, args.difficulties)
+    randomize(cache, random.Random(args.seed))
+    index, build_time = timed(lambda: SearchIndex(cache))
+    print(f"{len(index.beatmaps)} difficulties, {len(index.vocabulary)} words, index built in {build_time*1000:.0f} ms")
+    for key in SearchIndex.SORT_KEYS:
+        index.get_order(key)  # Sorted views are made once, not per keystroke
+
+    for label, clear in (("cold", True), ("warm", False)):
+        times = []
+        for query in QUERIES:
+            if clear:
+                index.prefixes.clear()
+            # Every keystroke of typing the query
+            for end in range(1, len(query) + 1):
+                _, elapsed = timed(lambda: index.search(query[:end], "title"))
+                times.append(elapsed * 1000)
+        times.sort()
+        print(f"{label:>5} prefixes: {len(times)} keystrokes, mean {sum(times) / len(times):.3f} ms,"
+              f" p99 {times[int(len(times) * 0.99)]:.3f} ms, max {times[-1]:.3f} ms")
+
+    added = make_cache(args.sets // 100, args.difficulties)
+    cache.beatmapsets = cache.beatmapsets[len(added.beatmapsets):] + added.beatmapsets
+    _, sync_time = timed(lambda: index.sync(cache))
+    _, search_time = timed(lambda: index.search("artist 1", "title"))
+    print(f"sync after replacing {len(added.beatmapsets)} sets: {sync_time*1000:.1f} ms,"
+          f" first search after it {search_time*1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Time to load a skin and get it ready for a beatmap, and to switch between skins.
+`--large` adds a synthetic skin shaped like a large community skin: every element in @2x, 4 combo colors,
+60 slider ball and 30 follow circle frames, big spinner layers and a few hundred files the game doesn't use.
+
+    python benchmarks/skin_load.py [--skins resources/default_skin path/to/community/skin ...] [--large]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame  # noqa: E402
+from configuration import ConfigurationManager  # noqa: E402
+from resource import SkinManager  # noqa: E402
+from util import ResolutionManager  # noqa: E402
+
+
+def write_image(image_path, size):
+    # Noise doesn't compress, so decoding costs about as much as it does for detailed artwork
+    pygame.image.save(pygame.image.fromstring(os.urandom(size[0] * size[1] * 4), size, "RGBA"), image_path)
+
+
+def write_large_skin(skin_path, frames=60, unused=400):
+    with open(os.path.join(skin_path, "skin.ini"), "w") as f:
+        f.write("[General]\nName: Large\nVersion: 2.7\n\n[Colours]\n")
+        for i in range(1, 5):
+            f.write(f"Combo{i}: {i * 60},{255 - i * 60},{i * 40}\n")
+    elements = {"hitcircle": 256, "hitcircleoverlay": 256, "approachcircle": 256, "sliderstartcircle": 256,
+                "sliderstartcircleoverlay": 256, "spinner-glow": 1024, "spinner-bottom": 1024,
+                "spinner-top": 1024, "spinner-middle": 256, "spinner-middle2": 1024,
+                "spinner-approachcircle": 640}
+    elements.update({f"sliderb{i}": 256 for i in range(frames)})
+    elements.update({f"sliderfollowcircle{i}": 512 for i in range(frames // 2)})
+    for name, size in elements.items():
+        write_image(os.path.join(skin_path, f"{name}@2x.png"), (size, size))
+    for i in range(10):
+        write_image(os.path.join(skin_path, f"default-{i}@2x.png"), (80, 104))
+    for i in range(unused):
+        write_image(os.path.join(skin_path, f"mania-note{i % 9}-{i}@2x.png"), (64, 64))
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Skin load and switch benchmark")
+    parser.add_argument("--skins", nargs="+", default=[os.path.join(ROOT, "resources", "default_skin")])
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--circle-size", type=float, default=4)
+    parser.add_argument("--large", action="store_true", help="also benchmark a synthetic large skin")
+    args = parser.parse_args()
+
+    pygame.display.init()
+    pygame.display.set_mode((args.width, args.height))
+    config = ConfigurationManager()
+    # Only measure the in memory texture cache, the disk one would make every run after the first a hit
+    config.set("rendering.skin_cache_path", None)
+    resolution = ResolutionManager((args.width, args.height))
+    resolution.load_size(args.circle_size)
+
+    skins = [os.path.abspath(skin_path) for skin_path in args.skins]
+    with tempfile.TemporaryDirectory() as temp_path:
+        if args.large:
+            skins.append(os.path.join(temp_path, "large"))
+            os.mkdir(skins[-1])
+            write_large_skin(skins[-1])
+        run(skins, resolution, config)
+
+
+def run(skins, resolution, config):
+    for i, skin_path in enumerate(skins):
+        skin, load_time = timed(lambda: SkinManager(skin_path, resolution, config))
+        _, ready_time = timed(skin.on_new_beatmap)
+        print(f"{os.path.basename(skin_path)} ({len(skin.files)} files)")
+        print(f"{'load (until decoding started)':>32}: {load_time*1000:8.1f} ms")
+        print(f"{'first beatmap (decode + scale)':>32}: {ready_time*1000:8.1f} ms")
+        _, again_time = timed(skin.on_new_beatmap)
+        print(f"{'next beatmap, same circle size':>32}: {again_time*1000:8.1f} ms")
+        # BeatmapLoader scales the approach circles in the background, on_new_beatmap leaves them until they're drawn
+        _, ladder_time = timed(lambda: skin.approach_circles.prepare(skin._approachcircle, skin.config.combo_colors,
+                                                                     resolution.object_size))
+        print(f"{'approach circles (loader)':>32}: {ladder_time*1000:8.1f} ms")
+
+        if len(skins) > 1:
+            other = skins[i - 1]
+            _, switch_time = timed(lambda: (skin.load_skin(other), skin.on_new_beatmap()))
+            _, back_time = timed(lambda: (skin.load_skin(skin_path), skin.on_new_beatmap()))
+            print(f"{'switch to ' + os.path.basename(other):>32}: {switch_time*1000:8.1f} ms")
+            print(f"{'switch back':>32}: {back_time*1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
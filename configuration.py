@@ -49,15 +49,45 @@ class ConfigurationManager(BaseConfig):
         self.configuration = {
             "__version": ConfigurationManager.version,
             "songs_path": None,
+            "library_path": "library.db",
+            "star_rating_path": "cache/star_ratings.bin",
+            # Processes calculating star ratings in the background, all cores but one if None
+            "star_rating_workers": None,
             "audio": Config(self, {
                 "volume": 0.05,
+                "disabled": False,
+                # ms between the mixer playing a sound and it being heard, gameplay runs this much behind the mixer
+                "latency": 0,
+                "pcm_cache_path": "cache/audio",
+                "pcm_cache_size": 512,  # MB
             }),
             "rendering": Config(self, {
                 "fps_cap": 60,
+                # Only redraw and update the parts of the screen that changed during gameplay
+                "dirty_rects": True,
+                # Pixels between the pre-scaled approach circle sizes, lower looks smoother but uses more memory
+                "approach_circle_tolerance": 2,
+                "approach_circle_cache_size": 64,  # MB
+                "slider_render_ahead": 5000,  # ms
+                "slider_cache_size": 256,  # MB
+                "slider_render_workers": 2,
+                "background_cache_path": "cache/backgrounds",
+                "skin_cache_size": 64,  # MB
+                # Degrees between the cached rotations of rotating elements like spinners
+                "transform_angle_step": 2,
+                "transform_cache_size": 96,  # MB
+                # Set to None to only keep scaled skin textures in memory
+                "skin_cache_path": "cache/skins",
+                "background_cache_size": 256,  # MB
                 "resolution": Config(self, {
                     "width": 640,
                     "height": 480,
                 }),
+            }),
+            "profiling": Config(self, {
+                "enabled": False,
+                "history": 600,  # frames
+                "csv_path": "frame_times.csv",
             })
         }
 
@@ -7,30 +7,55 @@ parser.add_argument('--width', '-sw', type=int)
 parser.add_argument('--height', '-sh', type=int)
 parser.add_argument("--fps", '-f', type=int)
 parser.add_argument('--volume', '-v', type=int)
-args = parser.parse_args()
-
-config = ConfigurationManager.load()
-
-if args.width is not None:
-    config.set("rendering.resolution.width", args.width)
-if args.height is not None:
-    config.set("rendering.resolution.height", args.height)
-if args.fps is not None:
-    config.set("rendering.fps_cap", args.fps)
-if args.volume is not None:
-    config.set("audio.volume", args.volume)
-config.save()
-
-
-from game import GameLoop
-from startscreen import StartScreen
-from gameplay import Gameplay
-
-
-states = {
-    "start": StartScreen,
-    "play": Gameplay
-}
-
-game = GameLoop(states, config)
-game.run("start")
+parser.add_argument('--headless', metavar="BEATMAP",
+                    help="render a .osu file without a window or audio and report frame times")
+parser.add_argument('--dt', type=float, default=1000/60, help="ms between headless frames")
+parser.add_argument('--duration', type=float, help="ms of the map to render headless, defaults to all of it")
+parser.add_argument('--output', choices=("none", "raw", "png"), default="none",
+                    help="where headless frames go: nowhere, raw RGB or a PNG sequence")
+parser.add_argument('--output-path', help="file for raw frames ('-' for stdout) or directory for PNGs")
+parser.add_argument('--debug', choices=("none", "few", "full"), default="none")
+parser.add_argument('--profile', action=argparse.BooleanOptionalAction,
+                    help="record per-stage frame times, shown with --debug full and written to a CSV on exit")
+# Star ratings are calculated in worker processes, which import this module again where they're spawned
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    config = ConfigurationManager.load()
+
+    if args.width is not None:
+        config.set("rendering.resolution.width", args.width)
+    if args.height is not None:
+        config.set("rendering.resolution.height", args.height)
+    if args.fps is not None:
+        config.set("rendering.fps_cap", args.fps)
+    if args.volume is not None:
+        config.set("audio.volume", args.volume)
+    if args.profile is not None:
+        config.set("profiling.enabled", args.profile)
+    config.save()
+
+    from enums import DebugMode
+
+    if args.headless is not None:
+        from headless import run_headless
+        if args.output == "png" and args.output_path is None:
+            parser.error("--output png needs --output-path")
+        run_headless(config, args.headless, args.dt, args.duration, args.output, args.output_path,
+                     DebugMode[args.debug.upper()])
+    else:
+        from game import GameLoop
+        from startscreen import StartScreen
+        from songselect import SongSelect
+        from loading import LoadingScreen
+        from gameplay import Gameplay
+
+        states = {
+            "start": StartScreen,
+            "select": SongSelect,
+            "loading": LoadingScreen,
+            "play": Gameplay
+        }
+
+        game = GameLoop(states, config, DebugMode[args.debug.upper()])
+        game.run("start")
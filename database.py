@@ -1,67 +1,139 @@
 import struct
+import array
+import gc
+import hashlib
+import mmap
+import sys
 import re
+import os
+import numpy as np
+from os import path
+from beatmap_reader import Beatmap
+
+
+# Compiled once instead of parsing the format string on every read
+SBYTE = struct.Struct("<b")
+UBYTE = struct.Struct("<B")
+CHAR = struct.Struct("<c")
+SHORT = struct.Struct("<h")
+USHORT = struct.Struct("<H")
+INT = struct.Struct("<i")
+UINT = struct.Struct("<I")
+LONG = struct.Struct("<q")
+ULONG = struct.Struct("<Q")
+FLOAT = struct.Struct("<f")
+DOUBLE = struct.Struct("<d")
 
 
 class Buffer:
-    def __init__(self, data):
-        self.data = data
+    """
+    Reads little-endian binary data. The data is wrapped in a memoryview so reads never copy it,
+    which also allows the buffer to be backed by an mmap of the file (see from_path).
+
+    With lazy_strings, read_string and read_chars return memoryviews of the encoded text
+    instead of decoding it. Cache fields decode those the first time they are accessed.
+    """
+
+    def __init__(self, data, lazy_strings=False):
+        self.data = memoryview(data)
         self.offset = 0
+        self.lazy_strings = lazy_strings
+        self._raw = data
+
+    @property
+    def raw(self):
+        """The underlying bytes-like object, slicing it copies but decodes faster than a memoryview."""
+        if isinstance(self._raw, memoryview):
+            self._raw = self._raw.tobytes()
+        return self._raw
+
+    def close(self):
+        """
+        Let go of the data, an mmap from from_path is closed so the file can be replaced.
+        """
+        self.data.release()
+        if isinstance(self._raw, mmap.mmap):
+            self._raw.close()
+
+    @classmethod
+    def from_path(cls, path, lazy_strings=True):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b"", lazy_strings)
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), lazy_strings)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def remaining(self):
+        return len(self.data) - self.offset
 
-    def _read(self, fmt, size):
-        data = struct.unpack(fmt, self.data[self.offset:self.offset+size])[0]
-        self.offset += size
+    def _read(self, st):
+        data = st.unpack_from(self.data, self.offset)[0]
+        self.offset += st.size
         return data
 
     def _read_raw(self, size):
-        data = self.data[self.offset:self.offset+size]
-        self.offset += size
+        end = self.offset + size
+        if end > len(self.data):
+            raise EOFError(f"Tried to read {size} bytes at {self.offset} from a buffer of {len(self.data)} bytes")
+        data = self.data[self.offset:end]
+        self.offset = end
         return data
 
-    def read_raw_bytes(self, size):
+    def skip(self, size):
+        self._read_raw(size)
+
+    def read_raw_view(self, size):
         return self._read_raw(size)
 
+    def read_raw_bytes(self, size):
+        return self._read_raw(size).tobytes()
+
     def read_sbyte(self):
-        return self._read("<b", 1)
+        return self._read(SBYTE)
 
     def read_ubyte(self):
-        return self._read("<B", 1)
+        return self._read(UBYTE)
 
     def read_bool(self):
         return bool(self.read_ubyte())
 
     def read_char(self):
-        return self._read("<c", 1)
+        return self._read(CHAR)
 
     def read_short(self):
-        return self._read("<h", 2)
+        return self._read(SHORT)
 
     def read_ushort(self):
-        return self._read("<H", 2)
+        return self._read(USHORT)
 
     def read_int(self):
-        return self._read("<i", 4)
+        return self._read(INT)
 
     def read_uint(self):
-        return self._read("<I", 4)
+        return self._read(UINT)
 
     def read_long(self):
-        return self._read("<q", 8)
+        return self._read(LONG)
 
     def read_ulong(self):
-        return self._read("<Q", 8)
+        return self._read(ULONG)
 
     def read_float(self):
-        return self._read("<f", 4)
+        return self._read(FLOAT)
 
     def read_double(self):
-        return self._read("<d", 8)
+        return self._read(DOUBLE)
 
     def read_byte_array(self):
         length = self.read_int()
         return self.read_raw_bytes(length) if length > 0 else None
 
     def _read_chars(self, length):
-        return self.read_raw_bytes(length).decode('utf-8')
+        data = self._read_raw(length)
+        return data if self.lazy_strings else str(data, "utf-8")
 
     def read_chars(self):
         length = self.read_int()
@@ -70,8 +142,10 @@ class Buffer:
     def read_ulb128(self):
         result = 0
         shift = 0
+        data = self.data
         while True:
-            byte = self.read_ubyte()
+            byte = data[self.offset]
+            self.offset += 1
             result |= (byte & 0b01111111) << shift
             if (byte & 0b10000000) == 0x00:
                 break
@@ -81,73 +155,658 @@ class Buffer:
     def read_string(self):
         if self.read_ubyte() != 0x0B:
             return
-        length = self.read_ulb128()
-        return self.read_raw_bytes(length).decode('utf-8')
+        return self._read_chars(self.read_ulb128())
+
+    def skip_string(self):
+        if self.read_ubyte() == 0x0B:
+            self.skip(self.read_ulb128())
 
     def read_datetime(self):
-        return self._read("<q", 8)
+        return self._read(LONG)
+
+    def read_array(self, typecode, count):
+        """
+        Read `count` little-endian values of an array.array typecode (e.g. "i", "d") in one go.
+        """
+        arr = array.array(typecode)
+        arr.frombytes(self._read_raw(arr.itemsize * count))
+        if sys.byteorder != "little":
+            arr.byteswap()
+        return arr
+
+    def read_numpy(self, dtype, count):
+        """
+        Read `count` fixed-width records straight into a NumPy array without copying.
+        `dtype` can be a structured dtype, e.g. np.dtype([("time", "<i4"), ("bpm", "<f8")]).
+        The array is read-only and shares memory with the buffer.
+        """
+        dtype = np.dtype(dtype)
+        return np.frombuffer(self._read_raw(dtype.itemsize * count), dtype=dtype, count=count)
+
+
+class BufferWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def _write(self, st, value):
+        self.data += st.pack(value)
+
+    def write_raw_bytes(self, data):
+        self.data += data
+
+    def write_sbyte(self, value):
+        self._write(SBYTE, value)
+
+    def write_ubyte(self, value):
+        self._write(UBYTE, value)
+
+    def write_bool(self, value):
+        self.write_ubyte(int(value))
+
+    def write_char(self, value):
+        self._write(CHAR, value)
+
+    def write_short(self, value):
+        self._write(SHORT, value)
+
+    def write_ushort(self, value):
+        self._write(USHORT, value)
+
+    def write_int(self, value):
+        self._write(INT, value)
+
+    def write_uint(self, value):
+        self._write(UINT, value)
+
+    def write_long(self, value):
+        self._write(LONG, value)
+
+    def write_ulong(self, value):
+        self._write(ULONG, value)
+
+    def write_float(self, value):
+        self._write(FLOAT, value)
+
+    def write_double(self, value):
+        self._write(DOUBLE, value)
+
+    def write_byte_array(self, value):
+        if not value:
+            return self.write_int(0)
+        self.write_int(len(value))
+        self.write_raw_bytes(value)
+
+    def write_chars(self, value):
+        self.write_byte_array(value.encode("utf-8") if value else None)
+
+    def write_ulb128(self, value):
+        while True:
+            byte = value & 0b01111111
+            value >>= 7
+            if value == 0:
+                return self.write_ubyte(byte)
+            self.write_ubyte(byte | 0b10000000)
+
+    def write_string(self, value):
+        if value is None:
+            return self.write_ubyte(0x00)
+        self.write_ubyte(0x0B)
+        value = value.encode("utf-8")
+        self.write_ulb128(len(value))
+        self.write_raw_bytes(value)
+
+    def write_datetime(self, value):
+        self._write(LONG, value)
+
+
+class LazyString:
+    """
+    Wraps the slot of a string field so text read by a lazy Buffer is only decoded on first access.
+    """
+
+    __slots__ = ("slot",)
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = self.slot.__get__(instance, owner)
+        if isinstance(value, memoryview):
+            value = str(value, "utf-8")
+            self.slot.__set__(instance, value)
+        return value
+
+    def __set__(self, instance, value):
+        self.slot.__set__(instance, value)
+
+
+FIXED_TYPES = {
+    "sbyte": "b", "ubyte": "B", "bool": "?", "char": "c", "short": "h", "ushort": "H", "int": "i",
+    "uint": "I", "long": "q", "ulong": "Q", "float": "f", "double": "d", "datetime": "q",
+}
+
+
+def read_ulb128(data, o):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[o]
+        o += 1
+        result |= (byte & 0b01111111) << shift
+        if (byte & 0b10000000) == 0x00:
+            return result, o
+        shift += 7
+
+
+def write_ulb128(out, value):
+    while value > 0b01111111:
+        out.append((value & 0b01111111) | 0b10000000)
+        value >>= 7
+    out.append(value)
+
+
+class SchemaCompiler:
+    """
+    Turns the `data` declaration of a Cache class into a specialized reader and writer.
+    The generated code works directly on the memoryview/bytearray with a local offset,
+    unpacks runs of fixed-width fields with a single struct.Struct and resolves nested
+    cache types once at compile time instead of on every record.
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.namespace = {
+            "cls": cls, "new": object.__new__, "str": str, "len": len, "EOFError": EOFError,
+            "INT": INT, "UINT": UINT, "pack": struct.pack,
+            "read_ulb128": read_ulb128, "write_ulb128": write_ulb128,
+        }
+        self.names = 0
+        self.lines = None
+
+    @staticmethod
+    def parse_rtype(rtype):
+        m = re.match(r"(?P<rtype>.*?)\[(?P<inrtype>.*)]", rtype)
+        if m:
+            t = m.group("rtype").lower()
+            if t not in ("list", "cache"):
+                raise ValueError(f"Type {t} cannot contain a nested type.")
+            return t, m.group("inrtype")
+        rtype = rtype.lower()
+        if rtype not in FIXED_TYPES and rtype not in ("string", "chars", "byte_array", "ulb128"):
+            raise ValueError(f"Unknown type {rtype}.")
+        return rtype, None
+
+    def add(self, prefix, value):
+        self.names += 1
+        name = f"{prefix}{self.names}"
+        self.namespace[name] = value
+        return name
+
+    def fixed_struct(self, fmt):
+        return self.add("ST", struct.Struct("<" + fmt))
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    def compile(self, name):
+        self.namespace["__name__"] = f"database.{self.cls.__name__}"
+        exec("\n".join(self.lines), self.namespace)
+        return self.namespace[name]
+
+    # Reader
+
+    def compile_reader(self):
+        cls = self.cls
+        self.lines = ["def read(data, o, lazy):", "    end = len(data)", "    obj = new(cls)"]
+        for attr in cls.__slots__:
+            if attr not in cls.data:
+                self.emit(1, f"obj.{attr} = None")
+
+        fields = list(cls.data.items())
+        i = 0
+        while i < len(fields):
+            group = []
+            while i < len(fields) and fields[i][1].lower() in FIXED_TYPES:
+                group.append(fields[i][0])
+                i += 1
+            if group:
+                fmt = "".join(FIXED_TYPES[cls.data[attr].lower()] for attr in group)
+                st = self.fixed_struct(fmt)
+                self.emit(1, f"{', '.join(f'v_{attr}' for attr in group)}, = {st}.unpack_from(data, o)")
+                self.emit(1, f"o += {struct.calcsize('<' + fmt)}")
+                for attr in group:
+                    self.emit(1, f"obj.{attr} = v_{attr}")
+                continue
+            attr, rtype = fields[i]
+            i += 1
+            self.read_value(1, f"v_{attr}", rtype, True)
+            descriptor = cls.__dict__.get(attr)
+            if isinstance(descriptor, LazyString):
+                # Store the raw view directly in the slot, LazyString decodes it on access
+                self.emit(1, f"{self.add('set_', descriptor.slot.__set__)}(obj, v_{attr})")
+            else:
+                self.emit(1, f"obj.{attr} = v_{attr}")
+        self.emit(1, "return obj, o")
+        return self.compile("read")
+
+    def read_value(self, indent, target, rtype, field):
+        t, inner = self.parse_rtype(rtype)
+        # Only fields can stay undecoded, strings nested in lists are decoded right away
+        decode = "if not lazy: " if field else ""
+        to_str = f"{target} = {target}.decode('utf-8')" if field else f"{target} = str({target}, 'utf-8')"
+        if t in FIXED_TYPES:
+            st = self.fixed_struct(FIXED_TYPES[t])
+            self.emit(indent, f"{target} = {st}.unpack_from(data, o)[0]")
+            self.emit(indent, f"o += {struct.calcsize('<' + FIXED_TYPES[t])}")
+        elif t == "ulb128":
+            self.emit(indent, f"{target}, o = read_ulb128(data, o)")
+        elif t == "string":
+            self.emit(indent, "if data[o] == 0x0B:")
+            self.emit(indent + 1, "n = data[o + 1]")
+            self.emit(indent + 1, "if n & 0b10000000:")
+            self.emit(indent + 2, "n, o = read_ulb128(data, o + 1)")
+            self.emit(indent + 1, "else:")
+            self.emit(indent + 2, "o += 2")
+            self.read_chars(indent + 1, target, decode + to_str)
+            self.emit(indent, "else:")
+            self.emit(indent + 1, f"{target} = None")
+            self.emit(indent + 1, "o += 1")
+        elif t in ("chars", "byte_array"):
+            self.emit(indent, "n = INT.unpack_from(data, o)[0]")
+            self.emit(indent, "o += 4")
+            self.emit(indent, "if n > 0:")
+            self.read_chars(indent + 1, target, decode + to_str
+                            if t == "chars" else f"{target} = bytes({target})")
+            self.emit(indent, "else:")
+            self.emit(indent + 1, f"{target} = None")
+        elif t == "list":
+            count = f"{target}_count"
+            self.emit(indent, f"{count} = UINT.unpack_from(data, o)[0]")
+            self.emit(indent, "o += 4")
+            inner_t, _ = self.parse_rtype(inner)
+            if inner_t in FIXED_TYPES:
+                st = self.fixed_struct(FIXED_TYPES[inner_t])
+                self.emit(indent, f"n = {count} * {st}.size")
+                self.emit(indent, "if o + n > end:")
+                self.emit(indent + 1, "raise EOFError(f'List of {n} bytes at {o} exceeds buffer of {end} bytes')")
+                self.emit(indent, f"{target} = [item[0] for item in {st}.iter_unpack(data[o:o + n])]")
+                self.emit(indent, "o += n")
+            else:
+                item = f"{target}_item"
+                self.emit(indent, f"{target} = []")
+                self.emit(indent, f"for _ in range({count}):")
+                self.read_value(indent + 1, item, inner, False)
+                self.emit(indent + 1, f"{target}.append({item})")
+        elif t == "cache":
+            reader = self.add("read_", Cache.get_codec(inner)[0])
+            self.emit(indent, f"{target}, o = {reader}(data, o, lazy)")
+
+    def read_chars(self, indent, target, convert):
+        self.emit(indent, f"{target} = data[o:o + n]")
+        self.emit(indent, "o += n")
+        self.emit(indent, "if o > end:")
+        self.emit(indent + 1, "raise EOFError(f'String of {n} bytes exceeds buffer of {end} bytes')")
+        self.emit(indent, convert)
+
+    # Writer
+
+    def compile_writer(self):
+        cls = self.cls
+        self.lines = ["def write(obj, out):"]
+        fields = list(cls.data.items())
+        i = 0
+        while i < len(fields):
+            group = []
+            while i < len(fields) and fields[i][1].lower() in FIXED_TYPES:
+                group.append(fields[i][0])
+                i += 1
+            if group:
+                st = self.fixed_struct("".join(FIXED_TYPES[cls.data[attr].lower()] for attr in group))
+                self.emit(1, f"out += {st}.pack({', '.join(f'obj.{attr}' for attr in group)})")
+                continue
+            attr, rtype = fields[i]
+            i += 1
+            self.emit(1, f"v_{attr} = obj.{attr}")
+            self.write_value(1, f"v_{attr}", rtype)
+        if not fields:
+            self.emit(1, "pass")
+        return self.compile("write")
+
+    def write_value(self, indent, value, rtype):
+        t, inner = self.parse_rtype(rtype)
+        if t in FIXED_TYPES:
+            self.emit(indent, f"out += {self.fixed_struct(FIXED_TYPES[t])}.pack({value})")
+        elif t == "ulb128":
+            self.emit(indent, f"write_ulb128(out, {value})")
+        elif t == "string":
+            self.emit(indent, f"if {value} is None:")
+            self.emit(indent + 1, "out.append(0x00)")
+            self.emit(indent, "else:")
+            self.emit(indent + 1, f"encoded = {value}.encode('utf-8')")
+            self.emit(indent + 1, "out.append(0x0B)")
+            self.emit(indent + 1, "write_ulb128(out, len(encoded))")
+            self.emit(indent + 1, "out += encoded")
+        elif t in ("chars", "byte_array"):
+            self.emit(indent, f"if not {value}:")
+            self.emit(indent + 1, "out += INT.pack(0)")
+            self.emit(indent, "else:")
+            self.emit(indent + 1, f"encoded = {value}.encode('utf-8')" if t == "chars" else f"encoded = {value}")
+            self.emit(indent + 1, "out += INT.pack(len(encoded))")
+            self.emit(indent + 1, "out += encoded")
+        elif t == "list":
+            self.emit(indent, f"if {value} is None:")
+            self.emit(indent + 1, f"{value} = ()")
+            self.emit(indent, f"out += UINT.pack(len({value}))")
+            inner_t, _ = self.parse_rtype(inner)
+            if inner_t in FIXED_TYPES:
+                self.emit(indent, f"out += pack(f'<{{len({value})}}{FIXED_TYPES[inner_t]}', *{value})")
+            else:
+                item = f"{value}_item"
+                self.emit(indent, f"for {item} in {value}:")
+                self.write_value(indent + 1, item, inner)
+        elif t == "cache":
+            writer = self.add("write_", Cache.get_codec(inner)[1])
+            self.emit(indent, f"{writer}({value}, out)")
 
 
 class Cache:
     data = {}
+    registry = {}
     __slots__ = ()
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Cache.registry[cls.__name__] = cls
+        for attr, rtype in cls.data.items():
+            slot = cls.__dict__.get(attr)
+            if rtype in ("string", "chars") and slot is not None:
+                setattr(cls, attr, LazyString(slot))
+
     def __init__(self):
         for attr in self.__slots__:
             setattr(self, attr, None)
 
-    @staticmethod
-    def interpret_rtype(buf, rtype):
-        m = re.match(r"(?P<rtype>.*)\[(?P<inrtype>.*)]", rtype)
-        if m:
-            return m.group("rtype"), m.group("inrtype")
-        return getattr(buf, f"read_{rtype}")
-
-    def read_buffer(self, buf, rtype):
-        t = self.interpret_rtype(buf, rtype)
-        if type(t) == str:
-            return getattr(buf, f"read_{t.lower()}")
-        t, it = t
-        if t.lower() == "list":
-            arr = []
-            for _ in range(buf.read_uint()):
-                arr.append(self.read_buffer(buf, it))
-            return arr
-        elif t.lower() == "cache":
-            return globals()[it].from_data(buf)
-        else:
-            raise ValueError(f"Type {t} cannot contain a nested type.")
+    @classmethod
+    def get_codec(cls, name=None):
+        """
+        Get the compiled (reader, writer) pair of this class, or of the registered cache class `name`.
+        They're only compiled once per class.
+        """
+        if name is not None:
+            if name not in cls.registry:
+                raise ValueError(f"Unknown cache type {name}.")
+            cls = cls.registry[name]
+        codec = cls.__dict__.get("_codec")
+        if codec is None:
+            compiler = SchemaCompiler(cls)
+            codec = (compiler.compile_reader(), compiler.compile_writer())
+            cls._codec = codec
+        return codec
 
     @classmethod
-    def from_path(cls, path):
-        with open(path, "rb") as f:
-            return cls.from_data(f.read())
+    def from_path(cls, path, lazy_strings=True):
+        """
+        With lazy_strings the strings are views of the mapped file, so it can't be replaced while the cache is
+        around. Without, everything is decoded right away and the file is closed.
+        """
+        data = Buffer.from_path(path, lazy_strings)
+        cache = cls.from_data(data)
+        if not lazy_strings:
+            data.close()
+        return cache
 
     @classmethod
     def from_data(cls, data):
         if not isinstance(data, Buffer):
             data = Buffer(data)
 
-        cache = cls()
-        for attr, rtype in cls.data.keys():
-            setattr(cache, attr, cache.read_buffer(data, rtype))
+        # Reading creates a lot of objects at once, don't let the garbage collector scan them repeatedly
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            cache, data.offset = cls.get_codec()[0](data.data if data.lazy_strings else data.raw,
+                                                    data.offset, data.lazy_strings)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return cache
+
+    def to_buffer(self, buf):
+        self.get_codec()[1](self, buf.data)
 
     def to_file(self, path):
-        with open(path, "wb") as f:
-            pass
+        # Written next to the index and then swapped in, so a write that's interrupted never leaves a broken index
+        buf = BufferWriter()
+        self.to_buffer(buf)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(buf.data)
+        os.replace(tmp_path, path)
 
 
 class OsuCache(Cache):
-    VERSION = 1
+    """
+    On-disk index of a songs folder, so startup doesn't have to parse every beatmap again.
+    Only beatmapset directories whose modification time changed since the index was written get re-parsed.
+    """
+
+    VERSION = 3
     data = {
         "version": "ushort",
+        "songs_path": "string",
         "beatmapsets": "list[cache[BeatmapsetCache]]"
     }
-    __slots__ = tuple(data.values())
+    __slots__ = tuple(data.keys())
+
+    @classmethod
+    def load_library(cls, songs_path, cache_path):
+        cache = None
+        if path.exists(cache_path):
+            try:
+                # Decoded up front, the index is replaced if the songs folder changed and a corrupted one
+                # is found here instead of when a string is first used
+                cache = cls.from_path(cache_path, lazy_strings=False)
+            except (struct.error, EOFError, IndexError, ValueError, UnicodeDecodeError) as e:
+                print(f"Library index is corrupted, rescanning songs folder... ({e})")
+        if cache is None or cache.version != cls.VERSION or cache.songs_path != songs_path:
+            cache = cls()
+            cache.version = cls.VERSION
+            cache.songs_path = songs_path
+            cache.beatmapsets = []
+
+        if cache.update():
+            cache.to_file(cache_path)
+        return cache
+
+    def update(self):
+        """
+        Re-parse any beatmapset that was added or modified since the index was written
+        and drop the ones that no longer exist. Returns whether anything changed.
+        """
+        known = {beatmapset.directory: beatmapset for beatmapset in self.beatmapsets}
+        beatmapsets = []
+        changed = False
+        for entry in os.scandir(self.songs_path):
+            if not entry.is_dir():
+                continue
+            beatmapset = known.pop(entry.name, None)
+            mtime = entry.stat().st_mtime
+            if beatmapset is None or beatmapset.mtime != mtime:
+                beatmapset = BeatmapsetCache.from_directory(entry.path, mtime, beatmapset)
+                changed = True
+            else:
+                beatmapset.set_path(entry.path)
+            if beatmapset.beatmaps:
+                beatmapsets.append(beatmapset)
+        self.beatmapsets = beatmapsets
+        return changed or bool(known)
 
 
 class BeatmapsetCache(Cache):
     data = {
-        "": "",
+        "directory": "string",
+        "mtime": "double",
+        "beatmaps": "list[cache[BeatmapCache]]",
     }
-    __slots__ = tuple(data.values())
+    __slots__ = tuple(data.keys()) + ("path",)
+
+    @classmethod
+    def from_directory(cls, directory, mtime, previous=None):
+        known = {beatmap.filename: beatmap for beatmap in previous.beatmaps} if previous is not None else {}
+
+        beatmapset = cls()
+        beatmapset.directory = path.basename(directory)
+        beatmapset.mtime = mtime
+        beatmapset.path = directory
+        beatmapset.beatmaps = []
+        for entry in os.scandir(directory):
+            if not entry.name.endswith(".osu") or not entry.is_file():
+                continue
+            stat = entry.stat()
+            beatmap = known.get(entry.name)
+            if beatmap is None or beatmap.mtime != stat.st_mtime or beatmap.size != stat.st_size:
+                beatmap = BeatmapCache.from_file(entry.path, stat)
+                if beatmap is None:
+                    continue
+            beatmap.path = entry.path
+            beatmapset.beatmaps.append(beatmap)
+        return beatmapset
+
+    def set_path(self, directory):
+        self.path = directory
+        for beatmap in self.beatmaps:
+            beatmap.path = path.join(directory, beatmap.filename)
+
+
+class BeatmapCache(Cache):
+    data = {
+        "filename": "string",
+        "mtime": "double",
+        "size": "ulong",
+        "audio_file": "string",
+        "artist": "string",
+        "title": "string",
+        "creator": "string",
+        "version": "string",
+        "source": "string",
+        "tags": "string",
+        "beatmap_id": "int",
+        "beatmapset_id": "int",
+        "approach_rate": "float",
+        "circle_size": "float",
+        "overall_difficulty": "float",
+        "hp_drain_rate": "float",
+        "length": "int",
+        # Of the .osu file, what star ratings are stored by (see StarRatingCache)
+        "md5": "string",
+    }
+    __slots__ = tuple(data.keys()) + ("path", "star_rating")
+
+    # Sections read when scanning, (section, key): (attribute, type)
+    HEADER_FIELDS = {
+        ("General", "AudioFilename"): ("audio_file", str),
+        ("Metadata", "Artist"): ("artist", str),
+        ("Metadata", "Title"): ("title", str),
+        ("Metadata", "Creator"): ("creator", str),
+        ("Metadata", "Version"): ("version", str),
+        ("Metadata", "Source"): ("source", str),
+        ("Metadata", "Tags"): ("tags", str),
+        ("Metadata", "BeatmapID"): ("beatmap_id", int),
+        ("Metadata", "BeatmapSetID"): ("beatmapset_id", int),
+        ("Difficulty", "ApproachRate"): ("approach_rate", float),
+        ("Difficulty", "CircleSize"): ("circle_size", float),
+        ("Difficulty", "OverallDifficulty"): ("overall_difficulty", float),
+        ("Difficulty", "HPDrainRate"): ("hp_drain_rate", float),
+    }
+
+    @classmethod
+    def from_file(cls, beatmap_path, stat):
+        """
+        Only the header sections are parsed, the hit objects are parsed once the beatmap gets played
+        (see get_beatmap). The length is when the last hit object ends, so it comes out short in the rare
+        beatmap where an earlier slider or spinner ends after it.
+        """
+        try:
+            with open(beatmap_path, "rb") as f:
+                data = f.read()
+            # The hit objects are most of the file, only what comes before them is decoded
+            header_end = data.find(b"[HitObjects]")
+            header = (data if header_end == -1 else data[:header_end]).decode("utf-8-sig")
+
+            cache = cls()
+            cache.overall_difficulty = cache.hp_drain_rate = 5.0
+            cache.approach_rate = None
+            cache.circle_size = 5.0
+            cache.beatmap_id = cache.beatmapset_id = 0
+            slider_multiplier = 1.4
+            timing_points = []
+            section = None
+            for line in header.splitlines():
+                line = line.strip()
+                if not line or line.startswith("//"):
+                    continue
+                if line[0] == "[" and line[-1] == "]":
+                    section = line[1:-1]
+                elif section == "TimingPoints":
+                    timing_points.append(line.split(","))
+                elif ":" in line:
+                    key, value = line.split(":", 1)
+                    key = key.strip()
+                    value = value.strip()
+                    if section == "Difficulty" and key == "SliderMultiplier":
+                        slider_multiplier = float(value)
+                    field = cls.HEADER_FIELDS.get((section, key))
+                    # Numbers that are left empty keep their default
+                    if field is not None and (value or field[1] is str):
+                        setattr(cache, field[0], field[1](value))
+
+            hit_objects = data[header_end + len(b"[HitObjects]"):].strip() if header_end != -1 else b""
+            last_line = hit_objects.rpartition(b"\n")[2].decode()
+            cache.length = cls.get_end_time(last_line, timing_points, slider_multiplier) if last_line else 0
+        except (OSError, ValueError, IndexError, UnicodeDecodeError) as e:
+            print(f"Skipping {beatmap_path}: {e}")
+            return
+
+        if cache.approach_rate is None:
+            # Old beatmaps used the overall difficulty for both
+            cache.approach_rate = cache.overall_difficulty
+        cache.filename = path.basename(beatmap_path)
+        cache.mtime = stat.st_mtime
+        cache.size = stat.st_size
+        cache.md5 = hashlib.md5(data).hexdigest()
+        cache.path = beatmap_path
+        return cache
+
+    @staticmethod
+    def get_end_time(line, timing_points, slider_multiplier):
+        """
+        When the hit object of a [HitObjects] line ends in ms.
+        """
+        values = line.split(",")
+        time, object_type = int(float(values[2])), int(values[3])
+        if object_type & 8:  # Spinner
+            return int(values[5])
+        if object_type & 128:  # Mania hold note
+            return int(values[5].split(":")[0])
+        if not object_type & 2:
+            return time
+
+        # Slider, its duration depends on the timing points active at its start
+        beat_length, velocity = 500, 1
+        for point in timing_points:
+            if float(point[0]) > time:
+                break
+            length = float(point[1])
+            uninherited = len(point) < 7 or point[6] == "1"
+            if uninherited:
+                beat_length, velocity = length, 1
+            elif length < 0:
+                velocity = 100 / -length
+        slides, pixel_length = int(values[6]), float(values[7])
+        return int(time + pixel_length / (slider_multiplier * 100 * velocity) * beat_length * slides)
+
+    def get_beatmap(self):
+        """Create the full beatmap for this entry. It still has to be loaded before it's played."""
+        return Beatmap.from_path(self.path)
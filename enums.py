@@ -9,3 +9,16 @@ class DebugMode(Enum):
 
 class SkinOption(IntEnum):
     CURRENT_COMBO_COLOR = 0
+
+
+class ObjectKind(IntEnum):
+    CIRCLE = 0
+    SLIDER = 1
+    SPINNER = 2
+
+
+class RenderState(IntEnum):
+    NONE = 0
+    PENDING = 1
+    READY = 2
+    FAILED = 3
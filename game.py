@@ -1,9 +1,14 @@
+import time
 import pygame
 import tkinter as tk
 from tkinter import filedialog
 from resource import ResourceManager
 from util import ResolutionManager
-from beatmap_reader import SongsFolder
+from database import OsuCache
+from starrating import StarRatingCache
+from audio import AudioManager
+from timing import make_frame_timer
+from enums import DebugMode
 
 
 class BaseState:
@@ -14,6 +19,9 @@ class BaseState:
         pass
 
     def draw(self):
+        """
+        Returns the rects of the screen that changed, or None to update all of it.
+        """
         pass
 
     def on_quit(self):
@@ -21,29 +29,40 @@ class BaseState:
 
 
 class GameLoop:
-    def __init__(self, states, config):
+    def __init__(self, states, config, debug_mode=DebugMode.NONE):
         self.states = states
         self.config = config
+        self.debug_mode = debug_mode
+        self.timer = make_frame_timer(config)
         self.current_state = None
         self.running = False
         self.switched = False
         self.clock = pygame.time.Clock()
+        # What gameplay time runs on, in seconds
+        self.time_source = time.perf_counter
         self.fps_cap = config.get("rendering.fps_cap")
 
         print("Loading songs folder...")
-        self.songs_folder = SongsFolder.from_path(config.get('songs_path')
+        self.songs_folder = OsuCache.load_library(config.get('songs_path')
                                                   if config.get('songs_path') is not None
-                                                  else self.ask_songs_folder())
+                                                  else self.ask_songs_folder(),
+                                                  config.get('library_path'))
         print("Songs folder loaded.")
+        # SearchIndex of the songs folder, built the first time song select is opened
+        self.search_index = None
+        self.star_ratings = StarRatingCache(config.get("star_rating_path"), config.get("star_rating_workers"))
+        self.star_ratings.start(self.songs_folder)
 
         pygame.init()
         pygame.font.init()
+        if not config.get("audio.disabled"):
+            AudioManager.init_mixer()
         pygame.display.set_caption("osu!simulation")
         res = config.get("rendering.resolution")
         self.screen = pygame.display.set_mode((res.get("width"), res.get("height")))
 
         self.resolution = ResolutionManager(self.screen.get_size())
-        self.resources = ResourceManager(self.resolution)
+        self.resources = ResourceManager(self.resolution, config)
 
     def ask_songs_folder(self):
         root = tk.Tk()
@@ -68,16 +87,29 @@ class GameLoop:
     def run(self, starting_state, *args, **kwargs):
         self.switch_state(starting_state, *args, **kwargs)
         self.running = True
+        timer = self.timer
         while self.running:
+            timer.start_frame()
             self.handle_events()
+            timer.mark("events")
             if not self.running: break
             if self.switched:
                 self.switched = False
                 continue
             self.current_state.handle_state()
-            self.current_state.draw()
-
-            pygame.display.update()
+            self.star_ratings.update(self.search_index)
+            timer.mark("state")
+            rects = self.current_state.draw()
+            timer.mark("draw")
+
+            if rects is None:
+                pygame.display.update()
+            else:
+                pygame.display.update(rects)
+            timer.mark("display")
+            timer.end_frame()
             self.clock.tick(self.fps_cap)
 
+        self.star_ratings.stop()
+        timer.dump_csv(self.config.get("profiling.csv_path"))
         pygame.quit()
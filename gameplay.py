@@ -1,12 +1,16 @@
 from game import BaseState
-from util import ObjectManager
-from os import path
-from enums import DebugMode
-from audio import AudioManager
-from beatmap_reader import HitObjectType
+from enums import DebugMode, ObjectKind
+from timing import PlaybackClock
+from loading import BeatmapLoader
 import pygame
 
 
+# Degrees per ms at 477 rpm, how fast auto spins
+SPINNER_SPEED = 477 * 360 / 60000
+# Height of the biggest spinner layer relative to the screen
+SPINNER_HEIGHT = 667 / 768
+
+
 class GameStateManager:
     def __init__(self, beatmap=None, clock=None, object_manager=None):
         if beatmap is not None:
@@ -16,6 +20,7 @@ class GameStateManager:
         if object_manager is not None:
             self.object_manager = object_manager
         self.current_offset = min(0, self.beatmap.hit_objects[0].time - self.object_manager.preempt - 3000)
+        self.clock.seek(self.current_offset)
         self.current_combo_color = 0
         self.counted_objects = []
         self.cursor_pos = (0, 0)
@@ -34,7 +39,12 @@ class GameStateManager:
         return self.current_offset > (last_obj.time if not hasattr(last_obj, "end_time") else last_obj.end_time)
 
     def skip(self):
-        self.current_offset = self.beatmap.hit_objects[0].time - 2500
+        self.seek(self.beatmap.hit_objects[0].time - 2500)
+
+    def seek(self, offset):
+        self.current_offset = offset
+        self.clock.seek(offset)
+        self.background_fading = offset < self.beatmap.hit_objects[0].time
 
     def get_background_fade(self):
         opacity = round(max(50, (self.beatmap.hit_objects[0].time - self.current_offset) / 500 * 255))
@@ -43,93 +53,131 @@ class GameStateManager:
         return opacity
 
     def advance(self):
-        self.current_offset += self.clock.get_time()
+        self.current_offset = self.clock.update()
 
 
 class Gameplay(BaseState):
-    def __init__(self, game, beatmap, debug_mode=DebugMode.NONE):
+    def __init__(self, game, loader, debug_mode=None):
+        """
+        `loader` is a BeatmapLoader, this waits for it if it hasn't finished yet and applies it.
+        """
         self.game = game
         self.screen = game.screen
         self.size = self.screen.get_size()
-        self.beatmap = beatmap
-        self.debug_mode = debug_mode
+        self.beatmap = loader.wait().apply().beatmap
+        self.star_rating = loader.star_rating
+        self.debug_mode = debug_mode if debug_mode is not None else game.debug_mode
+        self.timer = game.timer
+        self.use_dirty_rects = game.config.get("rendering.dirty_rects")
+        self.background_layer = None
+        # Areas drawn over in the last frame
+        self.dirty_rects = []
         self.key_events = {
             pygame.K_ESCAPE: self.to_start_screen,
+            pygame.K_SPACE: self.skip,
         }
 
         self.audio_started = False
 
-        print("Loading beatmap...")
-        beatmap.load()
-
         self.resolution = game.resolution
         self.resources = game.resources
-        self.object_manager = ObjectManager(beatmap, self.resolution, self.resources)
-        self.audio_manager = AudioManager(game.config.get("audio.volume"))
-        self.state = GameStateManager(self.beatmap, game.clock, self.object_manager)
-
-        # More map loading
-        self.resolution.load_size(beatmap.difficulty.circle_size)
-        self.resources.load_map(beatmap)
-        self.background = self.get_background_path(beatmap)
-        if self.background is not None:
-            self.set_background(self.background)
-        print("Beatmap loaded.")
+        self.object_manager = loader.object_manager
+        self.audio_manager = loader.audio_manager
+        self.playback = PlaybackClock(self.audio_manager, game.config.get("audio.latency"), game.time_source)
+        self.state = GameStateManager(self.beatmap, self.playback, self.object_manager)
+
+        self.background = None
+        self.background_future = loader.background_future
+        self.check_background()
 
     def to_start_screen(self):
         self.stop_and_cleanup()
         self.game.switch_state("start")
 
+    def skip(self):
+        if not self.state.can_skip:
+            return
+        self.state.skip()
+        if self.audio_started:
+            self.audio_manager.seek(self.state.current_offset)
+
     def stop_and_cleanup(self):
-        self.audio_manager.stop_audio()
-
-    @staticmethod
-    def get_background_path(beatmap):
-        for event in beatmap.events:
-            event = event.split(",")
-            if len(event) == 5 and event[0] == "0" and event[1] == "0":
-                return path.join(path.split(beatmap.path)[0], event[2] if '"' not in event[2] else event[2][1:-1])
-
-    def set_background(self, bg_path):
-        self.background = pygame.image.load(bg_path)
-        background_ratio = self.size[1] / self.background.get_size()[1] + 0.1
-        size = (self.background.get_size()[0] * background_ratio,
-                self.background.get_size()[1] * background_ratio)
-        try:
-            self.background = pygame.transform.smoothscale(self.background, size).convert()
-        except ValueError:
-            self.background = pygame.transform.scale(self.background, size).convert()
+        self.audio_manager.close()
+        self.object_manager.sliders.stop()
 
-    def debug_blit(self, *args, n=0, pixel_skip=19):
-        self.screen.blit(*args)
-        return n + pixel_skip
+    def on_quit(self):
+        self.stop_and_cleanup()
+
+    def check_background(self):
+        """
+        Use the background once the cache has it ready, until then nothing is drawn behind the objects.
+        """
+        if self.background_future is None or not self.background_future.done():
+            return
+        future, self.background_future = self.background_future, None
+        try:
+            self.background = future.result().convert()
+        except (OSError, pygame.error) as e:
+            return print(f"Couldn't load background: {e}")
+        self.background.set_alpha(self.state.get_background_fade())
+        self.background_layer = None
+
+    def blit(self, surf, position, area=None):
+        rect = self.screen.blit(surf, position, area)
+        self.dirty_rects.append(rect)
+        return rect
+
+    def draw_text(self, text, position, color=(255, 255, 255), number=""):
+        """
+        Draw cached text followed by a number drawn from a digit atlas.
+        """
+        rect = self.resources.text.draw(self.screen, self.resources.font, text, color, position, number)
+        self.dirty_rects.append(rect)
+        return rect
 
     def draw_debug(self):
-        # TODO: make a helper class for creating and drawing debug so this looks cleaner
-        font = self.resources.font
-        text_surface = font.render(f'Map: {self.beatmap.metadata.artist} - '
-                                        f'{self.beatmap.metadata.title} '
-                                        f'[{self.beatmap.metadata.version}] '
-                                        f'({self.beatmap.metadata.creator}) '
-                                        # f'{round(self.beatmap.nm_sr, 2)}*, '  # TODO: star rating
-                                        f'AR: {self.beatmap.difficulty.approach_rate}, '
-                                        f'CS: {self.beatmap.difficulty.circle_size}'
-                                        if self.beatmap is not None else "No map loaded.", True,
-                                        (255, 255, 255))
         font_size = self.resources.font_size
-        debug_y_offset = 0
-        debug_y_offset = self.debug_blit(
-            text_surface, (0, debug_y_offset), n=debug_y_offset, pixel_skip=font_size)
+        self.draw_text(f'Map: {self.beatmap.metadata.artist} - '
+                       f'{self.beatmap.metadata.title} '
+                       f'[{self.beatmap.metadata.version}] '
+                       f'({self.beatmap.metadata.creator}) '
+                       f'{"?" if self.star_rating is None else round(self.star_rating, 2)}*, '
+                       f'AR: {self.beatmap.difficulty.approach_rate}, '
+                       f'CS: {self.beatmap.difficulty.circle_size}'
+                       if self.beatmap is not None else "No map loaded.", (0, 0))
         if self.debug_mode is DebugMode.FULL:
-            # Render
-            offset_render = font.render(f'Offset: {self.state.current_offset}', True, (255, 255, 255))
-            tick_render = font.render(f'pygame.time.get_ticks(): {pygame.time.get_ticks()}',
-                                      True, (255, 255, 255))
-
-            # Blit
-            debug_y_offset = self.debug_blit(offset_render, (0, debug_y_offset),
-                                             n=debug_y_offset, pixel_skip=font_size)
-            self.debug_blit( tick_render, (0, debug_y_offset), n=debug_y_offset, pixel_skip=font_size)
+            self.draw_text('Offset: ', (0, font_size), number=str(self.state.current_offset))
+            self.draw_text('pygame.time.get_ticks(): ', (0, font_size * 2), number=str(pygame.time.get_ticks()))
+            self.draw_sync_stats(font_size * 3)
+            self.draw_hitsound_stats(font_size * 4)
+            if self.timer.enabled:
+                self.draw_frame_graph(font_size * 5)
+
+    def draw_sync_stats(self, y):
+        stats = self.playback.get_drift_stats()
+        if stats is None:
+            return self.draw_text('A/V drift: no audio', (0, y))
+        last, mean, max_drift = stats
+        x = self.draw_text('A/V drift: ', (0, y), number=f'{last:.1f}').right
+        x = self.draw_text(' ms, mean ', (x, y), number=f'{mean:.1f}').right
+        x = self.draw_text(' ms, max ', (x, y), number=f'{max_drift:.1f}').right
+        self.draw_text(' ms, latency ', (x, y), number=str(self.playback.latency))
+
+    def draw_hitsound_stats(self, y):
+        mean, max_latency, stolen, dropped = self.audio_manager.samples.get_stats()
+        x = self.draw_text('Hitsound latency: ', (0, y), number=f'{mean:.1f}').right
+        x = self.draw_text(' ms, max ', (x, y), number=f'{max_latency:.1f}').right
+        x = self.draw_text(' ms, channels stolen ', (x, y), number=str(stolen)).right
+        self.draw_text(', dropped ', (x, y), number=str(dropped))
+
+    def draw_frame_graph(self, y):
+        graph = self.timer.make_graph((min(300, self.size[0]), self.size[1] // 6))
+        self.blit(graph, (0, y))
+        x = graph.get_width() + 4
+        for stage, color, time in zip(self.timer.STAGES, self.timer.COLORS, self.timer.get_means(30)):
+            rect = self.draw_text(f'{stage}: ', (x, y), color, f'{time:.2f}')
+            self.draw_text(' ms', (rect.right, y), color)
+            y += self.resources.font_size
 
     def draw_background(self):
         if self.background is None:
@@ -139,6 +187,36 @@ class Gameplay(BaseState):
         self.screen.blit(self.background, (self.size[0]/2-(self.background.get_size()[0]/2),
                                            self.size[1]/2-(self.background.get_size()[1]/2)))
 
+    def make_background_layer(self):
+        """
+        The dimmed background as it looks once it stopped fading, for restoring the areas objects were drawn over.
+        """
+        layer = pygame.Surface(self.size).convert()
+        layer.fill((0, 0, 0))
+        if self.background is not None:
+            self.background.set_alpha(self.state.get_background_fade())
+            layer.blit(self.background, (self.size[0]/2-(self.background.get_size()[0]/2),
+                                         self.size[1]/2-(self.background.get_size()[1]/2)))
+        return layer
+
+    def restore_background(self):
+        """
+        Draw the background for this frame. Returns whether the whole screen was redrawn.
+        """
+        self.check_background()
+        if self.state.background_fading and self.background is not None or not self.use_dirty_rects:
+            self.background_layer = None
+            self.screen.fill((0, 0, 0))
+            self.draw_background()
+            return True
+        if self.background_layer is None:
+            self.background_layer = self.make_background_layer()
+            self.screen.blit(self.background_layer, (0, 0))
+            return True
+        for rect in self.dirty_rects:
+            self.screen.blit(self.background_layer, rect, rect)
+        return False
+
     def draw_playfield(self):
         pygame.draw.rect(self.screen, (255, 0, 0),
                          self.resolution.get_playfield_rect(),
@@ -148,27 +226,33 @@ class Gameplay(BaseState):
                          width=1)
 
     def draw_objects(self):
-        for hit_object in self.object_manager.get_hit_objects_for_offset(self.state.current_offset):
-            # Spinners not yet implemented
-            if hit_object.type == HitObjectType.SPINNER:
-                self.draw_spinner(hit_object)
+        object_manager = self.object_manager
+        for i in object_manager.get_indices_for_offset(self.state.current_offset):
+            hit_object = object_manager.hit_objects[i]
+            kind = object_manager.kinds[i]
+            if kind == ObjectKind.SPINNER:
+                self.draw_spinner(i)
                 continue
 
             # Get opacity for hit object
-            opacity = self.object_manager.get_opacity(hit_object, self.state.current_offset)
-            combo_color = self.object_manager.get_combo_color(hit_object)
+            opacity = object_manager.get_opacity(i, self.state.current_offset)
+            combo_color = object_manager.get_combo_color(i)
 
             # Draw slider body
-            if hit_object.type == HitObjectType.SLIDER:
-                hit_object.surf.set_alpha(opacity)
-                self.screen.blit(hit_object.surf, (0, 0))
+            if kind == ObjectKind.SLIDER:
+                body, body_position = object_manager.sliders.get(i)
+                if body is not None:
+                    body.set_alpha(opacity)
+                    self.blit(body, body_position)
+                else:
+                    self.draw_slider_placeholder(i, combo_color)
                 # Draw slider ball and follow circle
                 if self.state.current_offset >= hit_object.time:
                     for element in (self.resources.skin.sliderball, self.resources.skin.sliderfollowcircle):
-                        self.screen.blit(self.resources.skin.config.get_animation_frame(
+                        self.blit(self.resources.skin.config.get_animation_frame(
                             hit_object.time, self.state.current_offset, element,
                             combo_color if isinstance(element[0], list) else None),
-                            self.object_manager.get_sliderball_position(self.state.current_offset, hit_object, self.resolution)
+                            object_manager.get_sliderball_position(i, self.state.current_offset)
                         )
                 hitcircle, hitcircleoverlay = self.resources.skin.get_circle_elements(combo_color, True)
             else:
@@ -178,44 +262,80 @@ class Gameplay(BaseState):
             hitcircleoverlay.set_alpha(opacity)
 
             # Draw the rest of the hit object
-            position = self.resolution.get_hitcircle_position(hit_object)
-            self.screen.blit(hitcircle, position)
+            position = object_manager.get_position(i)
+            self.blit(hitcircle, position)
             if self.resources.skin.config.hit_circle_overlay_above_number:
-                self.screen.blit(hitcircleoverlay, position)
-                self.draw_number(hit_object, opacity, position)
+                self.blit(hitcircleoverlay, position)
+                self.draw_number(i, opacity, position)
             else:
-                self.draw_number(hit_object, opacity, position)
-                self.screen.blit(hitcircleoverlay, position)
+                self.draw_number(i, opacity, position)
+                self.blit(hitcircleoverlay, position)
             if self.state.current_offset <= hit_object.time:
-                self.draw_approach_circle(hit_object, opacity, position, combo_color)
+                self.draw_approach_circle(i, opacity, position, combo_color)
+
+    def draw_slider_placeholder(self, index, combo_color):
+        points = self.object_manager.sliders.get_placeholder(index)
+        if len(points) > 1:
+            self.dirty_rects.append(pygame.draw.lines(
+                self.screen, self.resources.skin.config.combo_colors[combo_color], False, points,
+                max(1, self.resolution.object_size // 8)))
 
-    def draw_approach_circle(self, hit_object, opacity, position, combo_color):
+    def draw_approach_circle(self, index, opacity, position, combo_color):
         # Get the size of the approach circle
         approachcircle_size = round(self.object_manager.get_ac_multiplier(
-            hit_object, self.state.current_offset) * self.resolution.object_size)
-        # Prepare the approach circle to the correct size
-        self.resources.skin.make_approach_circle(approachcircle_size, combo_color)
-
-        approachcircle = self.resources.skin.approachcircle
+            index, self.state.current_offset) * self.resolution.object_size)
+        # Look up the pre-scaled approach circle closest to that size
+        approachcircle = self.resources.skin.approach_circles.get(approachcircle_size, combo_color)
 
         # Set opacity and draw
         approachcircle.set_alpha(opacity)
-        offset = (approachcircle_size - self.resolution.object_size) // 2
-        self.screen.blit(approachcircle, tuple(map(lambda x: x - offset, position)))
-
-    def draw_number(self, hit_object, opacity, position):
-        number = self.object_manager.get_combo_number(hit_object)
-        num_pos_offset = self.resolution.object_size // (len(str(number))+1)
-        num_pos_start = position[0] + num_pos_offset
-        for i, num in enumerate(str(number)):
-            img = self.resources.skin.defaults[int(num)]
-            img.set_alpha(opacity)
-            pos = (num_pos_start + i*num_pos_offset - img.get_size()[0] // 2,
-                   position[1] + self.resolution.object_size // 2 - img.get_size()[1] // 2)
-            self.screen.blit(img, pos)
-
-    def draw_spinner(self, hit_object):
-        pass
+        offset = (approachcircle.get_width() - self.resolution.object_size) // 2
+        self.blit(approachcircle, tuple(map(lambda x: x - offset, position)))
+
+    def draw_number(self, index, opacity, position):
+        number = self.resources.skin.combo_numbers.get(self.object_manager.get_combo_number(index))
+        number.set_alpha(opacity)
+        self.blit(number, (position[0] + (self.resolution.object_size - number.get_width()) // 2,
+                           position[1] + (self.resolution.object_size - number.get_height()) // 2))
+
+    def draw_spinner(self, index):
+        """
+        Spinners spin at the speed auto spins them with, the bottom layer turns slower than the top one.
+        Rotations and scales come from the transform cache, so after the first turn drawing one is only blits.
+        """
+        skin, transforms = self.resources.skin, self.resources.transforms
+        offset = self.state.current_offset
+        start, end = self.object_manager.start_times[index], self.object_manager.end_times[index]
+        opacity = self.object_manager.get_opacity(index, offset)
+        center = tuple(self.resolution.actual_placement_offset[i] + self.resolution.actual_playfield_size[i] / 2
+                       for i in (0, 1))
+
+        # Skins without the new style layers use a single spinner circle
+        rotating = ((skin.spinner_bottom, 0.25), (skin.spinner_top, 1)) if skin.spinner_bottom is not None \
+            else ((skin.spinner_circle, 1),)
+        base = rotating[0][0]
+        if base is None:
+            return
+        # Everything is scaled like the biggest layer, which covers most of the screen's height
+        scale = self.size[1] * SPINNER_HEIGHT / base.get_height()
+        angle_step = transforms.get_angle_step([transforms.get(surf, 0, scale) for surf, _ in rotating
+                                                if surf is not None])
+        angle = -max(0, offset - start) * SPINNER_SPEED
+
+        layers = [(skin.spinner_glow, 0, scale, None)]
+        layers += [(surf, angle * speed, scale, None) for surf, speed in rotating]
+        layers += [(skin.spinner_middle, 0, scale, None), (skin.spinner_middle2, 0, scale, None)]
+        if offset >= start and end > start and skin.spinner_approachcircle is not None:
+            # It shrinks through every size, so it's cached at fewer of them
+            approach_scale = scale * (end - offset) / (end - start)
+            layers.append((skin.spinner_approachcircle, 0, approach_scale,
+                           transforms.get_scale_step(skin.spinner_approachcircle, scale)))
+        for surf, layer_angle, layer_scale, scale_step in layers:
+            if surf is None:
+                continue
+            surf = transforms.get(surf, layer_angle, layer_scale, angle_step, crop=True, scale_step=scale_step)
+            surf.set_alpha(opacity)
+            self.blit(surf, surf.get_rect(center=center))
 
     def draw_cursor(self):
         pygame.draw.circle(self.screen, (255, 0, 0), self.resolution.get_cursor_position(self.state.cursor_pos), 4)
@@ -227,19 +347,36 @@ class Gameplay(BaseState):
                          (self.size[0]-164, self.size[1]-64-25, self.audio_manager.volume*100, 16), 0)
 
     def draw(self):
-        self.screen.fill((0, 0, 0))
-        self.draw_background()
+        """
+        Returns the areas of the screen that changed, or None if all of it did.
+        """
+        full_redraw = self.restore_background()
+        self.timer.mark("background")
+        previous_rects = self.dirty_rects
+        self.dirty_rects = []
         self.draw_objects()
+        self.timer.mark("objects")
         if self.debug_mode != DebugMode.NONE:
             self.draw_debug()
 
+        if full_redraw:
+            return
+        rects = previous_rects + self.dirty_rects
+        # Updating the whole screen at once is cheaper than updating many rects that cover most of it
+        if sum(rect.w * rect.h for rect in rects) > self.size[0] * self.size[1] // 2:
+            return
+        return rects
+
     def handle_state(self):
         if not self.audio_started and self.state.current_offset >= 0:
-            self.audio_manager.load_and_play_audio(self.beatmap.general.audio_file,
+            self.audio_manager.load_and_play_audio(BeatmapLoader.get_audio_path(self.beatmap),
                                                    offset=self.state.current_offset,
                                                    is_beatmap_audio=True)
             self.audio_started = True
+        self.audio_manager.update()
         self.state.advance()
+        self.audio_manager.samples.update(self.state.current_offset)
+        self.object_manager.sliders.update(self.state.current_offset)
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN:
@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import contextlib
+import numpy as np
+# Raw frames can be written to stdout, keep pygame's greeting out of them
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import pygame  # noqa: E402
+from beatmap_reader import Beatmap  # noqa: E402
+from resource import ResourceManager  # noqa: E402
+from util import ResolutionManager  # noqa: E402
+from enums import DebugMode  # noqa: E402
+from gameplay import Gameplay  # noqa: E402
+from loading import BeatmapLoader  # noqa: E402
+from timing import make_frame_timer  # noqa: E402
+from starrating import StarRatingCache  # noqa: E402
+
+
+class FixedClock:
+    """
+    Stands in for pygame.time.Clock so every frame advances the game by exactly `dt` ms.
+    """
+
+    def __init__(self, dt):
+        self.dt = dt
+        self.fps = 1000 / dt
+        self.frames = 0
+
+    def tick(self, framerate=0):
+        self.frames += 1
+        return self.dt
+
+    def time(self):
+        """
+        Seconds passed, moves by `dt` every tick.
+        """
+        return self.frames * self.dt / 1000
+
+    def get_time(self):
+        return self.dt
+
+    def get_fps(self):
+        return self.fps
+
+
+class HeadlessGame:
+    """
+    Runs a state without a window or audio as fast as possible with a fixed timestep,
+    for measuring rendering performance.
+    """
+
+    def __init__(self, config, dt, debug_mode=DebugMode.NONE):
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        config.set("audio.disabled", True)
+
+        self.config = config
+        self.debug_mode = debug_mode
+        self.timer = make_frame_timer(config)
+        self.clock = FixedClock(dt)
+        self.time_source = self.clock.time
+        self.current_state = None
+
+        pygame.display.init()
+        pygame.font.init()
+        res = config.get("rendering.resolution")
+        self.screen = pygame.display.set_mode((res.get("width"), res.get("height")))
+
+        self.resolution = ResolutionManager(self.screen.get_size())
+        self.resources = ResourceManager(self.resolution, config)
+        # Only what's already calculated, nothing is calculated in the background
+        self.star_ratings = StarRatingCache(config.get("star_rating_path"))
+
+    def switch_state(self, state, *args, **kwargs):
+        pass
+
+    def run(self, gameplay, duration=None, output="none", output_path=None, wait_for_sliders=True):
+        """
+        Render the map frame by frame and return the time every frame took in ms.
+        `output` is "none", "raw" (RGB frames written to `output_path`, or stdout if it's "-") or "png".
+        """
+        state = gameplay.state
+        end = state.current_offset + duration if duration is not None else None
+        frame_times = []
+        raw_file = None
+        if output == "raw":
+            # sys.stdout may be redirected to stderr, see run_headless
+            raw_file = sys.__stdout__.buffer if output_path in (None, "-") else open(output_path, "wb")
+        elif output == "png":
+            os.makedirs(output_path, exist_ok=True)
+
+        if wait_for_sliders and gameplay.background_future is not None:
+            # Frames are compared between runs, so the background has to be there from the first one
+            try:
+                gameplay.background_future.result()
+            except (OSError, pygame.error) as e:
+                print(f"Couldn't load background: {e}")
+        try:
+            while not state.map_ended and (end is None or state.current_offset < end):
+                if wait_for_sliders:
+                    gameplay.object_manager.sliders.wait_for_visible(state.current_offset)
+                start = time.perf_counter()
+                self.timer.start_frame()
+                self.clock.tick()
+                gameplay.handle_state()
+                self.timer.mark("state")
+                gameplay.draw()
+                self.timer.mark("draw")
+                self.timer.end_frame()
+                frame_times.append((time.perf_counter() - start) * 1000)
+
+                if raw_file is not None:
+                    raw_file.write(pygame.image.tostring(self.screen, "RGB"))
+                elif output == "png":
+                    pygame.image.save(self.screen, os.path.join(output_path, f"{len(frame_times):06d}.png"))
+        finally:
+            gameplay.stop_and_cleanup()
+            self.timer.dump_csv(self.config.get("profiling.csv_path"))
+            if raw_file is not None:
+                raw_file.flush()
+                if raw_file is not sys.__stdout__.buffer:
+                    raw_file.close()
+        return np.array(frame_times)
+
+
+def run_headless(config, beatmap_path, dt=1000/60, duration=None, output="none", output_path=None,
+                 debug_mode=DebugMode.NONE):
+    # Raw frames can go to stdout, so everything else goes to stderr
+    log = sys.stderr if output == "raw" and output_path in (None, "-") else sys.stdout
+    with contextlib.redirect_stdout(log):
+        game = HeadlessGame(config, dt, debug_mode)
+        gameplay = Gameplay(game, BeatmapLoader(game, Beatmap.from_path(beatmap_path)))
+        game.current_state = gameplay
+
+        start = time.perf_counter()
+        frame_times = game.run(gameplay, duration, output, output_path)
+        elapsed = time.perf_counter() - start
+        pygame.quit()
+
+        if len(frame_times) == 0:
+            return print("No frames were rendered.")
+        print(f"Rendered {len(frame_times)} frames in {elapsed:.2f}s ({len(frame_times) / elapsed:.1f} fps overall)")
+        print(f"Frame time: mean {frame_times.mean():.2f} ms ({1000 / frame_times.mean():.1f} fps), " +
+              ", ".join(f"p{p} {np.percentile(frame_times, p):.2f} ms" for p in (50, 90, 99)) +
+              f", max {frame_times.max():.2f} ms")
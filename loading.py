@@ -0,0 +1,203 @@
+import math
+import threading
+import pygame
+from os import path
+from beatmap_reader import HitObjectType
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait
+from game import BaseState
+from database import BeatmapCache
+from resource import BeatmapResourceManager
+from util import ObjectManager, ResolutionManager
+from audio import AudioManager
+
+
+class BeatmapLoader:
+    """
+    Gets a beatmap ready to be played in a thread pool. The beatmap is parsed and its folder indexed first,
+    then the skin is resized for it while its objects are indexed and its hitsounds decoded, and the
+    background is requested from the background cache. The first sliders start rendering before gameplay does.
+    Everything is loaded into the loader's own objects, apply() hands them to the game from the main thread.
+    Only one beatmap loads at a time, the next one waits for it.
+    """
+
+    STAGES = ("beatmap", "skin", "objects", "audio")
+    # Runs the pipelines, one at a time
+    pipeline = ThreadPoolExecutor(max_workers=1, thread_name_prefix="beatmap-load")
+
+    def __init__(self, game, beatmap):
+        self.game = game
+        # Either a Beatmap or a BeatmapCache entry that the beatmap gets read from
+        self.beatmap = beatmap
+        self.star_rating = None
+        self.resolution = ResolutionManager(game.resolution.screen_size)
+        self.beatmap_resources = BeatmapResourceManager()
+        self.skin = None
+        self.object_manager = None
+        self.audio_manager = None
+        self.background_future = None
+        self.finished_stages = []
+        self.cancelled = threading.Event()
+        # The stages that run at the same time
+        self.executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="beatmap-stage")
+        self.future = self.pipeline.submit(self.load)
+
+    @property
+    def done(self):
+        return self.future.done()
+
+    @property
+    def progress(self):
+        return len(self.finished_stages) / len(self.STAGES)
+
+    @staticmethod
+    def get_background_path(beatmap):
+        for event in beatmap.events:
+            event = event.split(",")
+            if len(event) == 5 and event[0] == "0" and event[1] == "0":
+                return path.join(path.split(beatmap.path)[0], event[2] if '"' not in event[2] else event[2][1:-1])
+
+    @staticmethod
+    def get_audio_path(beatmap):
+        return path.join(path.dirname(beatmap.path), beatmap.general.audio_file)
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise CancelledError
+
+    def run_stage(self, stage, func, *args):
+        self.check_cancelled()
+        result = func(*args)
+        self.finished_stages.append(stage)
+        return result
+
+    def load(self):
+        try:
+            print("Loading beatmap...")
+            star_ratings = self.game.star_ratings
+            if isinstance(self.beatmap, BeatmapCache):
+                self.star_rating = star_ratings.get(self.beatmap.md5)
+                self.beatmap = self.beatmap.get_beatmap()
+            else:
+                self.star_rating = star_ratings.get_file(self.beatmap.path)
+            self.run_stage("beatmap", self.beatmap.load)
+
+            resources = self.game.resources
+            self.resolution.load_size(self.beatmap.difficulty.circle_size)
+            self.beatmap_resources.path = path.dirname(self.beatmap.path)
+            self.beatmap_resources.load_map()
+            bg_path = self.get_background_path(self.beatmap)
+            if bg_path is not None:
+                self.background_future = resources.backgrounds.get(bg_path, self.game.screen.get_size())
+            spinners = any(hit_object.type == HitObjectType.SPINNER for hit_object in self.beatmap.hit_objects)
+            # The approach circle ladder is scaled here rather than while the first objects are drawn
+            skin = self.executor.submit(self.run_stage, "skin", resources.skin.prepare,
+                                        self.resolution.object_size, spinners, True)
+            objects = self.executor.submit(self.run_stage, "objects", ObjectManager,
+                                           self.beatmap, self.resolution, resources, self.game.config)
+            audio = self.executor.submit(self.run_stage, "audio", self.load_audio)
+            # Every stage is done before one that failed raises, so what the others loaded gets discarded
+            stages = (skin, objects, audio)
+            wait(stages)
+            self.skin, self.object_manager, self.audio_manager = map(self.get_result, stages)
+            for stage in stages:
+                stage.result()
+            self.check_cancelled()
+            first = self.object_manager.hit_objects[0].time
+            self.object_manager.sliders.update(min(0, first - self.object_manager.preempt - 3000))
+            print("Beatmap loaded.")
+        except BaseException:
+            self.discard()
+            raise
+        finally:
+            self.executor.shutdown(wait=False)
+        return self
+
+    @staticmethod
+    def get_result(future):
+        return future.result() if future.exception() is None else None
+
+    def load_audio(self):
+        config, resources = self.game.config, self.game.resources
+        audio_manager = AudioManager(config.get("audio.volume"), config.get("audio.disabled"))
+        audio_manager.samples.load(self.beatmap.general.sample_set,
+                                   self.beatmap_resources.files, resources.skin.files)
+        audio_manager.samples.schedule(self.beatmap.hit_objects)
+        if not audio_manager.is_disabled:
+            audio_manager.pcm = resources.audio.get(self.get_audio_path(self.beatmap))
+        return audio_manager
+
+    def wait(self):
+        """
+        Block until the beatmap is loaded, raises whatever loading it raised.
+        """
+        return self.future.result()
+
+    def apply(self):
+        """
+        Make the loaded beatmap the game's current one, called from the main thread when gameplay takes it.
+        """
+        resources = self.game.resources
+        self.game.resolution.load_size(self.beatmap.difficulty.circle_size)
+        resources.beatmap = self.beatmap_resources
+        resources.skin.apply(self.skin)
+        return self
+
+    def cancel(self):
+        """
+        Stop loading and throw away what got loaded. Loading stops before the next stage,
+        or doesn't start at all if it's still waiting for another beatmap.
+        """
+        self.cancelled.set()
+        self.future.cancel()
+        self.future.add_done_callback(lambda future: self.discard())
+
+    def discard(self):
+        """
+        Stop rendering sliders and close the audio of whatever got loaded.
+        """
+        if self.object_manager is not None:
+            self.object_manager.sliders.stop()
+            self.object_manager = None
+        if self.audio_manager is not None:
+            self.audio_manager.close()
+            self.audio_manager = None
+
+
+class LoadingScreen(BaseState):
+    def __init__(self, game, loader):
+        self.game = game
+        self.screen = game.screen
+        self.size = self.screen.get_size()
+        self.resources = game.resources
+        self.loader = loader
+
+        self.pekora_angle = 0
+
+    def handle_state(self):
+        self.pekora_angle = (self.pekora_angle + 1) % 360
+        if not self.loader.done:
+            return
+        error = self.loader.future.exception()
+        if error is None:
+            return self.game.switch_state("play", self.loader)
+        self.game.switch_state("start")
+        self.game.current_state.status_message = f"Couldn't load beatmap: {error}"
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            self.loader.cancel()
+            self.game.switch_state("start")
+
+    def on_quit(self):
+        self.loader.cancel()
+
+    def draw(self):
+        self.screen.fill((0, 0, 0))
+        rotated_image = self.resources.transforms.get(self.resources.pekora, self.pekora_angle)
+        self.screen.blit(rotated_image, rotated_image.get_rect(center=(self.size[0] / 2, self.size[1] / 2)))
+
+        bar_width = self.size[0] // 3
+        bar_y = self.size[1] / 2 + self.size[1] * 0.2
+        pygame.draw.rect(self.screen, (255, 255, 255), (self.size[0] / 2 - bar_width / 2, bar_y, bar_width, 8), 1)
+        pygame.draw.rect(self.screen, (255, 255, 255), (self.size[0] / 2 - bar_width / 2, bar_y,
+                                                        math.ceil(bar_width * self.loader.progress), 8), 0)
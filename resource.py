@@ -1,16 +1,25 @@
+import os
+import mmap
+import struct
+import hashlib
 from os import path
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 import pygame
 import math
 from enums import SkinOption
 
 
 class ResourceManager:
-    def __init__(self, resolution):
+    def __init__(self, resolution, config):
         self.resolution = resolution
         self.path = "resources"
         self.skin = SkinManager(
-            path.join(self.path, "default_skin"), resolution)
+            path.join(self.path, "default_skin"), resolution, config)
         self.beatmap = BeatmapResourceManager()
+        self.backgrounds = BackgroundCache(config.get("rendering.background_cache_path"),
+                                           config.get("rendering.background_cache_size") * 1024 * 1024)
+        self.audio = PCMCache(config.get("audio.pcm_cache_path"), config.get("audio.pcm_cache_size") * 1024 * 1024)
 
         pekora = pygame.image.load(path.join(self.path, "pekora.png"))
         self.pekora = pygame.transform.smoothscale(pekora, (128, 128)).convert_alpha()
@@ -18,38 +27,62 @@ class ResourceManager:
         self.font = pygame.font.Font(path.join(self.path, "Torus.otf"), self.font_size)
         self.pekora_font = pygame.font.Font(path.join(self.path, "Torus.otf"),
                                             int(24 * self.resolution.screen_size[1] / 1080))
+        self.text = TextCache()
+        self.transforms = TransformCache(config.get("rendering.transform_angle_step"),
+                                         config.get("rendering.transform_cache_size") * 1024 * 1024)
 
     def load_skin(self, skin_path):
         self.skin.load_skin(skin_path)
 
-    def load_map(self, map_path):
-        self.beatmap.path = map_path
+    def load_map(self, beatmap):
+        """
+        Load everything for the beatmap right away, BeatmapLoader does the same in the background.
+        """
+        self.beatmap.path = path.dirname(beatmap.path)
         self.beatmap.load_map()
         self.skin.on_new_beatmap()
 
 
 class BaseManager:
+    def index_files(self):
+        """
+        Map the lowercase names of the files in the folder to their paths with a single scandir,
+        so looking for the variants of an element doesn't stat every candidate. Skins aren't case sensitive.
+        The entries are kept for get_mtime().
+        """
+        try:
+            self.entries = {entry.name.lower(): entry for entry in os.scandir(self.path) if entry.is_file()}
+        except OSError:
+            self.entries = {}
+        self.files = {name: entry.path for name, entry in self.entries.items()}
+
+    def get_mtime(self, name):
+        # DirEntry caches the stat, on Windows it even comes with the scandir
+        return self.entries[name].stat().st_mtime_ns
+
+    def find(self, name):
+        return self.files.get(name.lower())
+
     def parse_file_name(self, name, animation=False):
         a = name.split(".")
         base_name, ext = ".".join(a[:-1]), a[-1]
-        ret = (path.join(self.path, name), path.join(self.path, f"{base_name}@2x.{ext}"))
+        ret = (name, f"{base_name}@2x.{ext}")
         if animation:
-            ret += (path.join(self.path, f"{base_name}0.{ext}"), path.join(self.path, f"{base_name}0@2x.{ext}"))
+            ret += (f"{base_name}0.{ext}", f"{base_name}0@2x.{ext}")
         return ret
 
-    def format_animation_name(self, a_path, i):
-        root, name = path.split(a_path)
+    def format_animation_name(self, name, i):
         name = name.split(".")
         base_name, ext = ".".join(name[:-1]), name[-1]
         if base_name.endswith("@2x"):
-            return path.join(root, f"{base_name[:-3]}{str(i)}@2x.{ext}")
-        return path.join(root, f"{base_name}{str(i)}.{ext}")
+            return f"{base_name[:-3]}{str(i)}@2x.{ext}"
+        return f"{base_name}{str(i)}.{ext}"
 
-    def get_animations(self, a_path):
+    def get_animations(self, name):
         i = 0
         while True:
-            frame = self.format_animation_name(a_path, i)
-            if not path.exists(frame):
+            frame = self.find(self.format_animation_name(name, i))
+            if frame is None:
                 break
             yield pygame.image.load(frame).convert_alpha()
             i += 1
@@ -57,66 +90,121 @@ class BaseManager:
     def load_animation(self, name):
         sd, hd, sd_a, hd_a = self.parse_file_name(name, True)
         for a in ((hd_a, hd), (sd_a, sd)):
-            if path.exists(a[0]):
+            if self.find(a[0]) is not None:
                 return list(self.get_animations(a[1]))
         for s in (hd, sd):
-            if path.exists(s):
-                return [pygame.image.load(s).convert_alpha()]
+            if self.find(s) is not None:
+                return [pygame.image.load(self.find(s)).convert_alpha()]
 
     def load_image(self, name):
-        sd, hd = self.parse_file_name(name)
-        if path.exists(hd):
-            return pygame.image.load(hd).convert_alpha()
-        if path.exists(sd):
-            return pygame.image.load(sd).convert_alpha()
+        for s in reversed(self.parse_file_name(name)):
+            if self.find(s) is not None:
+                return pygame.image.load(self.find(s)).convert_alpha()
 
     def load_audio(self, name):
         pass
 
 
+class SkinElement:
+    """
+    An image (or animation, or several images) of a skin. Elements with `prefetch` start decoding
+    in the skin's thread pool as soon as the skin is loaded, the rest are only decoded when first used.
+    They're tinted with the combo colors only once they're scaled, which is a lot less to fill.
+    """
+
+    def __init__(self, file, animation=False, prefetch=True):
+        self.file = file
+        self.animation = animation
+        self.prefetch = prefetch
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        future = instance.pending.pop(self.name, None)
+        value = instance.__dict__[self.name] = future.result() if future is not None else self.load(instance)
+        return value
+
+    def load(self, skin):
+        if self.animation:
+            return skin.load_animation(self.file)
+        if isinstance(self.file, tuple):
+            return [skin.load_image(file) for file in self.file]
+        return skin.load_image(self.file)
+
+
 class SkinManager(BaseManager):
     """
     Manages all the resources of a skin such as hit objects and hit sounds.
     """
 
-    def __init__(self,  skin_path=None, resolution=None):
+    _hitcircle = SkinElement("hitcircle.png")
+    _hitcircleoverlay = SkinElement("hitcircleoverlay.png")
+    _approachcircle = SkinElement("approachcircle.png")
+    _sliderstartcircle = SkinElement("sliderstartcircle.png", prefetch=False)
+    _sliderstartcircleoverlay = SkinElement("sliderstartcircleoverlay.png", prefetch=False)
+    _sliderball = SkinElement("sliderb.png", animation=True)
+    _sliderfollowcircle = SkinElement("sliderfollowcircle.png", animation=True)
+    _defaults = SkinElement(tuple(f"default-{num}.png" for num in range(0, 10)))
+    # The elements scale_textures() uses
+    TEXTURES = ("_hitcircle", "_hitcircleoverlay", "_sliderstartcircle", "_sliderstartcircleoverlay", "_sliderball",
+                "_sliderfollowcircle", "_defaults")
+    # Only decoded for beatmaps that have spinners, see load_spinner()
+    spinner_glow = SkinElement("spinner-glow.png", prefetch=False)
+    spinner_bottom = SkinElement("spinner-bottom.png", prefetch=False)
+    spinner_top = SkinElement("spinner-top.png", prefetch=False)
+    spinner_middle = SkinElement("spinner-middle.png", prefetch=False)
+    spinner_middle2 = SkinElement("spinner-middle2.png", prefetch=False)
+    spinner_circle = SkinElement("spinner-circle.png", prefetch=False)
+    spinner_approachcircle = SkinElement("spinner-approachcircle.png", prefetch=False)
+
+    def __init__(self,  skin_path=None, resolution=None, game_config=None):
         if skin_path is not None:
             self.resolution = resolution
             self.path = skin_path
             self.config = SkinConfigParser(path.join(skin_path, "skin.ini"))
+            self.combo_numbers = ComboNumberCache()
+            self.approach_circles = ApproachCircleCache(
+                game_config.get("rendering.approach_circle_tolerance"),
+                game_config.get("rendering.approach_circle_cache_size") * 1024 * 1024)
+            self.textures = SkinTextureCache(game_config.get("rendering.skin_cache_size") * 1024 * 1024,
+                                             game_config.get("rendering.skin_cache_path"))
+            self.executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="skin-load")
 
-        self._hitcircles = self.create_combo_color_surfaces(self.load_image("hitcircle.png"))
+        self.index_files()
+        self.pending = {}
+        for name, element in vars(SkinManager).items():
+            if isinstance(element, SkinElement):
+                # Forget the elements of the previous skin
+                self.__dict__.pop(name, None)
+                if element.prefetch:
+                    self.pending[name] = self.executor.submit(element.load, self)
         self.hitcircles = []
-        self._hitcircleoverlay = self.load_image("hitcircleoverlay.png")
         self.hitcircleoverlay = None
-        self._approachcircle = self.create_combo_color_surfaces(self.load_image("approachcircle.png"))
-        self.approachcircle = None
-        self._sliderstartcircles = self.create_combo_color_surfaces(self.load_image("sliderstartcircle.png"))
         self.sliderstartcircles = []
-        self._sliderstartcircleoverlay = self.load_image("sliderstartcircleoverlay.png")
         self.sliderstartcircleoverlay = None
-        self._sliderball = self.load_animation("sliderb.png")
         self.sliderball = []
-        self._sliderfollowcircle = self.load_animation("sliderfollowcircle.png")
         self.sliderfollowcircle = []
-        self._defaults = [self.load_image(f"default-{num}.png") for num in range(0, 10)]
         self.defaults = []
 
-    def load_skin(self, path):
-        self.path = path
+    def load_skin(self, skin_path):
+        self.path = skin_path
+        self.config = SkinConfigParser(path.join(skin_path, "skin.ini"))
         self.__init__()
 
-    def resize(self, img):
-        return pygame.transform.smoothscale(img, (self.resolution.object_size, self.resolution.object_size))
+    def resize(self, img, size):
+        return pygame.transform.smoothscale(img, (size, size))
 
-    def scale(self, num_img, direction="v", downscale=1.0):
+    def scale(self, num_img, object_size, direction="v", downscale=1.0):
         w, h = num_img.get_size()
         if direction == "v":
-            size = (self.resolution.object_size / h * w * downscale,
-                    self.resolution.object_size * downscale)
+            size = (object_size / h * w * downscale,
+                    object_size * downscale)
         elif direction == "h":
-            size = (self.resolution.object_size * downscale,
-                    self.resolution.object_size / w * h * downscale)
+            size = (object_size * downscale,
+                    object_size / w * h * downscale)
         else:
             raise ValueError("direction must be either 'v' or 'h'")
         return pygame.transform.smoothscale(num_img, size)
@@ -132,19 +220,78 @@ class SkinManager(BaseManager):
         for surf, color in zip(imgs, self.config.combo_colors):
             surf.fill(color, special_flags=pygame.BLEND_RGBA_MULT)
 
+    def scale_textures(self, object_size):
+        def resize(img):
+            return self.resize(img, object_size)
+        textures = {
+            "hitcircles": self.create_combo_color_surfaces(resize(self._hitcircle)),
+            "sliderstartcircles": [],
+            "hitcircleoverlay": resize(self._hitcircleoverlay),
+            "sliderstartcircleoverlay": None,
+            "sliderball": list(map(self.create_combo_color_surfaces, map(resize, self._sliderball))),
+            "sliderfollowcircle": list(map(resize, self._sliderfollowcircle)),
+            "defaults": [self.scale(d, object_size, downscale=0.4) for d in self._defaults],
+        }
+        if self._sliderstartcircle is not None:
+            textures["sliderstartcircles"] = self.create_combo_color_surfaces(resize(self._sliderstartcircle))
+        if self._sliderstartcircleoverlay is not None:
+            textures["sliderstartcircleoverlay"] = resize(self._sliderstartcircleoverlay)
+        return textures
+
+    def load_spinner(self):
+        """
+        Decode the spinner layers, the old style spinner circle only if the skin doesn't have the new ones.
+        """
+        names = ["spinner_glow", "spinner_bottom", "spinner_top", "spinner_middle", "spinner_middle2",
+                 "spinner_approachcircle"]
+        if self.spinner_bottom is None:
+            names.append("spinner_circle")
+        for name in names:
+            getattr(self, name)
+
+    def prepare(self, object_size, spinners=False, approach_circles=False):
+        """
+        Scale everything for an object size without changing the skin, so it can run in the loader thread.
+        apply() makes the result the current textures. The spinner layers are decoded too if `spinners` is set,
+        and the approach circle ladder is scaled up front if `approach_circles` is set instead of as it's drawn.
+        """
+        if spinners:
+            self.load_spinner()
+        key = (path.abspath(self.path), object_size, tuple(map(tuple, self.config.combo_colors)),
+               self.get_texture_mtimes())
+        textures = self.textures.get(key, lambda: self.scale_textures(object_size))
+        ladder = None
+        if approach_circles:
+            ladder = self.approach_circles.prepare(self._approachcircle, self.config.combo_colors, object_size)
+        return key, textures, ladder
+
+    def get_texture_mtimes(self):
+        """
+        The names and mtimes of the files the textures are scaled from (and a few similarly named ones),
+        so editing, adding or removing any of them makes the textures get scaled again.
+        """
+        files = []
+        for name in self.TEXTURES:
+            file = getattr(SkinManager, name).file
+            files.extend(file if isinstance(file, tuple) else (file,))
+        prefixes = tuple(file.rsplit(".", 1)[0] for file in files)
+        return tuple(sorted((name, self.get_mtime(name)) for name in self.entries if name.startswith(prefixes)))
+
+    def apply(self, prepared):
+        """
+        Called from the main thread, textures read from the disk cache are converted here.
+        """
+        key, textures, ladder = prepared
+        textures = self.textures.convert(key, textures)
+        for name in SkinTextureCache.FIELDS:
+            setattr(self, name, textures[name])
+        # The overlap is in pixels of the unscaled digits
+        self.combo_numbers.build(self.defaults, self.config.hit_circle_overlap *
+                                 self.defaults[0].get_height() / self._defaults[0].get_height())
+        self.approach_circles.apply(self._approachcircle, self.config.combo_colors, key[1], ladder)
+
     def on_new_beatmap(self):
-        self.hitcircles = list(map(self.resize, self._hitcircles))
-        if self.sliderstartcircles:
-            self.sliderstartcircles = [self.resize(sliderstartcircles) for sliderstartcircles in self._sliderstartcircles]
-        self.hitcircleoverlay = self.resize(self._hitcircleoverlay)
-        if self.sliderstartcircleoverlay is not None:
-            self.sliderstartcircleoverlay = self.resize(self._sliderstartcircleoverlay)
-        self.sliderball = list(map(self.create_combo_color_surfaces, map(self.resize, self._sliderball)))
-        self.sliderfollowcircle = list(map(self.resize, self._sliderfollowcircle))
-        self.defaults = list(map(lambda d: self.scale(d, downscale=0.4), self._defaults))
-
-    def make_approach_circle(self, size, combo_color):
-        self.approachcircle = pygame.transform.smoothscale(self._approachcircle[combo_color], (size, size))
+        self.apply(self.prepare(self.resolution.object_size))
 
     def get_circle_elements(self, combo_color, is_slider=False):
         hitcircle = self.hitcircles[combo_color]
@@ -156,6 +303,465 @@ class SkinManager(BaseManager):
         return hitcircle, hitcircleoverlay
 
 
+def get_surface_size(value):
+    """
+    The bytes the pixels of a surface take up, or of all the surfaces in a list or dict.
+    """
+    if isinstance(value, pygame.Surface):
+        return value.get_bytesize() * value.get_width() * value.get_height()
+    if isinstance(value, dict):
+        return sum(map(get_surface_size, value.values()))
+    if isinstance(value, list):
+        return sum(map(get_surface_size, value))
+    return 0
+
+
+class LRUCache:
+    """
+    Values by key, the least recently used are dropped once their sizes add up to more than `max_size`.
+    Every value counts as 1 unless there's a `get_size`, like get_surface_size() for a budget in bytes.
+    The last value added is always kept, even if it's bigger than that on its own.
+    """
+
+    def __init__(self, max_size, get_size=None):
+        self.max_size = max_size
+        self.get_size = get_size
+        self.values = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def clear(self):
+        self.values.clear()
+        self.sizes.clear()
+        self.size = 0
+
+    def get(self, key):
+        value = self.values.get(key)
+        if value is not None:
+            self.values.move_to_end(key)
+        return value
+
+    def add(self, key, value):
+        """
+        Add or replace a value, returns the keys that were dropped to make room for it.
+        """
+        self.pop(key)
+        self.values[key] = value
+        self.sizes[key] = self.get_size(value) if self.get_size is not None else 1
+        self.size += self.sizes[key]
+        evicted = []
+        while self.size > self.max_size and len(self.values) > 1:
+            evicted.append(next(iter(self.values)))
+            self.pop(evicted[-1])
+        return evicted
+
+    def pop(self, key):
+        value = self.values.pop(key, None)
+        if key in self.sizes:
+            self.size -= self.sizes.pop(key)
+        return value
+
+
+class SkinTextureCache:
+    """
+    The skin textures scaled and tinted for an object size, keyed by (skin path, object size, combo colors,
+    mtimes of the skin's files), so maps with the same circle size reuse them instead of scaling everything again.
+    The least recently used sizes are dropped once they take up more than `max_size` bytes.
+    If `cache_path` is set they're also written there, so they don't have to be scaled again after a restart.
+    Textures read from there are left in their own format until they're passed to convert() on the main thread.
+    """
+
+    FIELDS = ("hitcircles", "sliderstartcircles", "hitcircleoverlay", "sliderstartcircleoverlay",
+              "sliderball", "sliderfollowcircle", "defaults")
+    MAGIC = b"CRSK"
+    TAG = struct.Struct("<B")
+    SIZE = struct.Struct("<II")
+    NONE, SURFACE, LIST = range(3)
+
+    def __init__(self, max_size=64 * 1024 * 1024, cache_path=None):
+        self.max_size = max_size
+        self.path = cache_path
+        self.textures = LRUCache(max_size, get_surface_size)
+        # Keys of the textures read from disk that aren't converted to the display's format yet
+        self.unconverted = set()
+        if cache_path is not None:
+            os.makedirs(cache_path, exist_ok=True)
+
+    def get(self, key, make):
+        """
+        The textures for the key, `make` is called to create them if they aren't cached in memory or on disk.
+        """
+        textures = self.textures.get(key)
+        if textures is not None:
+            return textures
+        if self.path is not None:
+            textures = self.read(key)
+            if textures is not None:
+                self.unconverted.add(key)
+        if textures is None:
+            textures = make()
+            if self.path is not None:
+                self.write(key, textures)
+
+        self.unconverted.difference_update(self.textures.add(key, textures))
+        return textures
+
+    @classmethod
+    def convert_value(cls, value):
+        if isinstance(value, pygame.Surface):
+            return value.convert_alpha()
+        if isinstance(value, list):
+            return list(map(cls.convert_value, value))
+        return value
+
+    def convert(self, key, textures):
+        """
+        Convert the textures got for the key if they were read from disk.
+        Surfaces can only be converted on the main thread once there is a display.
+        """
+        if key not in self.unconverted or pygame.display.get_surface() is None:
+            return textures
+        self.unconverted.discard(key)
+        for name in self.FIELDS:
+            textures[name] = self.convert_value(textures[name])
+        return textures
+
+    def get_file(self, key):
+        key = "|".join(map(str, key))
+        return path.join(self.path, hashlib.sha1(key.encode()).hexdigest() + ".skin")
+
+    def pack(self, value, out):
+        if value is None:
+            out.append(self.TAG.pack(self.NONE))
+        elif isinstance(value, pygame.Surface):
+            out.append(self.TAG.pack(self.SURFACE) + self.SIZE.pack(*value.get_size()))
+            out.append(pygame.image.tostring(value, "RGBA"))
+        else:
+            out.append(self.TAG.pack(self.LIST) + self.SIZE.pack(len(value), 0))
+            for item in value:
+                self.pack(item, out)
+
+    def unpack(self, data, offset):
+        tag, = self.TAG.unpack_from(data, offset)
+        offset += self.TAG.size
+        if tag == self.NONE:
+            return None, offset
+        width, height = self.SIZE.unpack_from(data, offset)
+        offset += self.SIZE.size
+        if tag == self.SURFACE:
+            end = offset + width * height * 4
+            return pygame.image.fromstring(data[offset:end], (width, height), "RGBA"), end
+        items = []
+        for _ in range(width):
+            item, offset = self.unpack(data, offset)
+            items.append(item)
+        return items, offset
+
+    def write(self, key, textures):
+        file = self.get_file(key)
+        out = [self.MAGIC]
+        for name in self.FIELDS:
+            self.pack(textures[name], out)
+        try:
+            atomic_write(file, out)
+            evict_files(self.path, ".skin", self.max_size)
+        except OSError as e:
+            print(f"Couldn't cache skin textures: {e}")
+
+    def read(self, key):
+        file = self.get_file(key)
+        if not path.exists(file):
+            return
+        with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:len(self.MAGIC)] != self.MAGIC:
+                return
+            textures = {}
+            offset = len(self.MAGIC)
+            try:
+                for name in self.FIELDS:
+                    textures[name], offset = self.unpack(m, offset)
+            except (struct.error, ValueError):
+                return
+        os.utime(file)
+        return textures
+
+
+class ApproachCircleCache:
+    """
+    Approach circles pre-scaled to a ladder of sizes `tolerance` pixels apart for every combo color,
+    so drawing one is a lookup instead of a smoothscale. Sizes are scaled when they're first drawn,
+    or all at once by prepare(). The sizes are further apart when the ladder for an object size wouldn't fit
+    in `max_size` bytes otherwise. Least recently used sizes are dropped once the surfaces take up more than that.
+    """
+
+    def __init__(self, tolerance=2, max_size=64 * 1024 * 1024):
+        self.tolerance = max(1, tolerance)
+        self.max_size = max_size
+        self.step = self.tolerance
+        self.image = None
+        self.colors = []
+        # The image tinted with every combo color, made once a size has to be scaled
+        self.images = None
+        self.surfaces = LRUCache(max_size, get_surface_size)
+
+    def snap(self, size, step=None):
+        step = step or self.step
+        return max(step, round(size / step) * step)
+
+    def get_sizes(self, object_size, step):
+        # Approach circles shrink from 3x to 1x the object size
+        return range(self.snap(object_size, step), self.snap(object_size * 3, step) + 1, step)
+
+    def get_step(self, color_amount, object_size):
+        """
+        The smallest step from `tolerance` up that fits the whole ladder for the object size in `max_size`.
+        """
+        step = self.tolerance
+        while step < object_size * 2 and \
+                sum(size * size * 4 for size in self.get_sizes(object_size, step)) * color_amount > self.max_size:
+            step += 1
+        return step
+
+    def get_images(self, image, colors):
+        if image is self.image and colors == self.colors and self.images is not None:
+            return self.images
+        images = [image.copy() for _ in colors]
+        for surf, color in zip(images, colors):
+            surf.fill(color, special_flags=pygame.BLEND_RGBA_MULT)
+        return images
+
+    def prepare(self, image, colors, object_size):
+        """
+        Scale the whole ladder for an object size, so it can run in the loader thread.
+        Sizes that are already scaled are reused as long as the image and colors stay the same.
+        The cache isn't changed until apply().
+        """
+        scaled = self.surfaces.values if image is self.image and colors == self.colors else {}
+        images = self.get_images(image, colors)
+        surfaces = {}
+        for size in self.get_sizes(object_size, self.get_step(len(colors), object_size)):
+            for combo_color in range(len(colors)):
+                surf = scaled.get((combo_color, size))
+                if surf is None:
+                    surf = pygame.transform.smoothscale(images[combo_color], (size, size))
+                surfaces[(combo_color, size)] = surf
+        return images, surfaces
+
+    def apply(self, image, colors, object_size, ladder=None):
+        """
+        Switch to the ladder for an object size, with the sizes from prepare() if there are any.
+        Sizes left over from earlier object sizes are kept if there's room.
+        """
+        if image is not self.image or colors != self.colors:
+            self.surfaces.clear()
+            self.image = image
+            self.colors = list(colors)
+            self.images = None
+        step = self.get_step(len(colors), object_size)
+        if step != self.step and step > self.tolerance:
+            print(f"Approach circles are {step} pixels apart instead of {self.tolerance} to fit in the cache, "
+                  f"raise rendering.approach_circle_cache_size to keep them closer")
+        self.step = step
+        if ladder is not None:
+            self.images, surfaces = ladder
+            for key, surf in surfaces.items():
+                self.surfaces.add(key, surf)
+
+    def get(self, size, combo_color):
+        key = (combo_color, self.snap(size))
+        surf = self.surfaces.get(key)
+        if surf is None:
+            self.images = self.get_images(self.image, self.colors)
+            surf = pygame.transform.smoothscale(self.images[combo_color], (key[1], key[1]))
+            self.surfaces.add(key, surf)
+        return surf
+
+
+def compose(surfaces, overlap=0):
+    """
+    The surfaces side by side on a transparent surface, centered vertically and each overlapping
+    the one before by `overlap` pixels. Returns the surface and where each one starts on it.
+    """
+    width = sum(surf.get_width() for surf in surfaces) - overlap * (len(surfaces) - 1)
+    height = max(surf.get_height() for surf in surfaces)
+    composed = pygame.Surface((max(1, width), height), pygame.SRCALPHA)
+    xs = []
+    x = 0
+    for surf in surfaces:
+        # Max blending keeps the colors intact on the transparent surface
+        composed.blit(surf, (x, (height - surf.get_height()) // 2), special_flags=pygame.BLEND_RGBA_MAX)
+        xs.append(x)
+        x += surf.get_width() - overlap
+    return composed, xs
+
+
+class ComboNumberCache:
+    """
+    One pre-composited surface per combo number, so a number is drawn with a single blit.
+    They're made when first needed and the least recently used are dropped past `max_amount`.
+    """
+
+    def __init__(self, max_amount=64):
+        self.digits = None
+        self.overlap = 0
+        self.surfaces = LRUCache(max_amount)
+
+    def build(self, digits, overlap):
+        self.surfaces.clear()
+        self.digits = digits
+        self.overlap = round(overlap)
+
+    def make(self, number):
+        return compose([self.digits[int(num)] for num in str(number)], self.overlap)[0]
+
+    def get(self, number):
+        surf = self.surfaces.get(number)
+        if surf is None:
+            surf = self.make(number)
+            self.surfaces.add(number, surf)
+        return surf
+
+
+class TransformCache:
+    """
+    Rotated and scaled copies of surfaces, with the angle snapped to `angle_step` degrees and the scale
+    to `scale_step`, made when first needed. The least recently used are dropped once they take up
+    more than `max_size` bytes.
+    """
+
+    def __init__(self, angle_step=2, max_size=96 * 1024 * 1024, scale_step=0.01):
+        self.angle_step = angle_step
+        self.scale_step = scale_step
+        self.max_size = max_size
+        self.surfaces = LRUCache(max_size, get_surface_size)
+
+    def get_angle_step(self, surfaces):
+        """
+        The smallest angle step at which every rotation of the surfaces fits in half of the cache,
+        so something that keeps rotating doesn't evict its own frames before they come around again.
+        """
+        return max(self.angle_step, 360 * get_surface_size(surfaces) / (self.max_size / 2))
+
+    def get_scale_step(self, surf, max_scale=1):
+        """
+        The smallest scale step at which every scale of the surface up to `max_scale` fits in an eighth of the cache,
+        for something that keeps shrinking, like a spinner's approach circle, so it doesn't make a new full size
+        copy every frame that pushes everything else out.
+        """
+        size = get_surface_size(surf) * max_scale ** 2
+        # The scales at step s take up about size * max_scale / s / 3 bytes
+        return max(self.scale_step, size * max_scale / (3 * self.max_size / 8))
+
+    def get(self, surf, angle=0, scale=1, angle_step=None, crop=False, scale_step=None):
+        """
+        `surf` rotated counterclockwise by `angle` degrees and scaled by `scale`. With `crop` the rotated surface
+        is cut to the size of the unrotated one, which is lossless for round things and saves memory.
+        """
+        angle_step = angle_step or self.angle_step
+        angle = round(angle % 360 / angle_step) * angle_step % 360
+        scale_step = scale_step or self.scale_step
+        scale = max(scale_step, round(scale / scale_step) * scale_step)
+        key = (surf, round(angle, 3), round(scale, 3), crop)
+        transformed = self.surfaces.get(key)
+        if transformed is not None:
+            return transformed
+
+        if angle == 0:
+            transformed = surf if key[2] == 1 else pygame.transform.smoothscale(
+                surf, (max(1, round(surf.get_width() * scale)), max(1, round(surf.get_height() * scale))))
+        else:
+            # Scaling once and rotating the scaled copy keeps the scaled copy around for the other angles
+            scaled = self.get(surf, 0, scale)
+            transformed = pygame.transform.rotozoom(scaled, angle, 1)
+            if crop:
+                rect = scaled.get_rect(center=transformed.get_rect().center)
+                transformed = transformed.subsurface(rect).copy()
+
+        self.surfaces.add(key, transformed)
+        return transformed
+
+
+class DigitAtlas:
+    """
+    The characters numbers are made of rendered once side by side, so a number is drawn
+    with a blit per character from this surface instead of rendering it.
+    """
+
+    CHARACTERS = "0123456789-.,:"
+
+    def __init__(self, font, color):
+        glyphs = [font.render(char, True, color) for char in self.CHARACTERS]
+        self.surface, xs = compose(glyphs)
+        self.height = self.surface.get_height()
+        self.rects = {char: pygame.Rect(x, 0, glyph.get_width(), self.height)
+                      for char, glyph, x in zip(self.CHARACTERS, glyphs, xs)}
+
+    def can_draw(self, text):
+        return all(char in self.rects for char in text)
+
+    def get_width(self, text):
+        return sum(self.rects[char].width for char in text)
+
+    def draw(self, surface, text, position):
+        x, y = position
+        for char in text:
+            rect = self.rects[char]
+            surface.blit(self.surface, (x, y), rect)
+            x += rect.width
+        return pygame.Rect(position[0], y, x - position[0], self.height)
+
+
+class TextCache:
+    """
+    Rendered text keyed by (font, text, color), the least recently used are dropped past `max_amount`.
+    Numbers that change every frame are drawn from a DigitAtlas instead of filling the cache up.
+    """
+
+    def __init__(self, max_amount=256):
+        self.surfaces = LRUCache(max_amount)
+        self.atlases = {}
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surf = self.surfaces.get(key)
+        if surf is None:
+            surf = font.render(text, True, color)
+            self.surfaces.add(key, surf)
+        return surf
+
+    def get_atlas(self, font, color):
+        atlas = self.atlases.get((font, color))
+        if atlas is None:
+            atlas = self.atlases[(font, color)] = DigitAtlas(font, color)
+        return atlas
+
+    def get_width(self, font, text, color, number=""):
+        atlas = self.get_atlas(font, color)
+        if not atlas.can_draw(number):
+            return self.render(font, text + number, color).get_width()
+        return (self.render(font, text, color).get_width() if text else 0) + atlas.get_width(number)
+
+    def draw(self, surface, font, text, color, position, number=""):
+        """
+        Draw `text` followed by `number`, returns the area that was drawn on.
+        """
+        atlas = self.get_atlas(font, color)
+        if not atlas.can_draw(number):
+            return surface.blit(self.render(font, text + number, color), position)
+        rect = pygame.Rect(position, (0, 0))
+        if text:
+            rect = surface.blit(self.render(font, text, color), position)
+        if number:
+            rect = rect.union(atlas.draw(surface, number, (position[0] + rect.width, position[1])))
+        return rect
+
+
 class SkinConfigParser:
     LATEST_VERSION = "2.7"
     VALID_VERSIONS = ["1.0", "2.0", "2.1", "2.2", "2.3", "2.4", "2.5", "2.6", "2.7"]
@@ -266,13 +872,216 @@ class SkinConfigParser:
         return frame
 
 
+class BackgroundCache:
+    """
+    Keeps beatmap backgrounds on disk already scaled to the screen, keyed by their path, mtime and the screen size.
+    Every file is a header followed by the raw RGBX pixels and gets memory mapped when read.
+    Backgrounds that aren't cached yet are decoded and scaled in a separate thread.
+    The least recently used files are removed when the cache grows over `max_size` bytes.
+    """
+
+    HEADER = struct.Struct("<4sII")
+    MAGIC = b"CRBG"
+
+    def __init__(self, cache_path, max_size=256 * 1024 * 1024):
+        self.path = cache_path
+        self.max_size = max_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(cache_path, exist_ok=True)
+
+    def get_file(self, bg_path, screen_size):
+        key = f"{path.abspath(bg_path)}|{os.stat(bg_path).st_mtime_ns}|{screen_size[0]}x{screen_size[1]}"
+        return path.join(self.path, hashlib.sha1(key.encode()).hexdigest() + ".bg")
+
+    def get(self, bg_path, screen_size):
+        """
+        Returns a future of the scaled background, which is already done if it was cached.
+        The surface isn't converted to the display format yet, that has to happen on the main thread.
+        """
+        future = Future()
+        try:
+            file = self.get_file(bg_path, screen_size)
+            surf = self.read(file)
+        except OSError as e:
+            future.set_exception(e)
+            return future
+        if surf is None:
+            return self.executor.submit(self.make, bg_path, screen_size, file)
+        future.set_result(surf)
+        return future
+
+    def read(self, file):
+        if not path.exists(file):
+            return
+        with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            magic, width, height = self.HEADER.unpack_from(m)
+            if magic != self.MAGIC or len(m) != self.HEADER.size + width * height * 4:
+                return
+            # The pixels are copied straight from the mapping into the surface, the mapped surface and view
+            # have to be gone before the mapping can close
+            pixels = memoryview(m)[self.HEADER.size:]
+            mapped = pygame.image.frombuffer(pixels, (width, height), "RGBX")
+            surf = mapped.copy()
+            del mapped
+            pixels.release()
+        # Mark it as recently used
+        os.utime(file)
+        return surf
+
+    def make(self, bg_path, screen_size, file):
+        background = pygame.image.load(bg_path)
+        ratio = screen_size[1] / background.get_height() + 0.1
+        size = (round(background.get_width() * ratio), round(background.get_height() * ratio))
+        try:
+            background = pygame.transform.smoothscale(background, size)
+        except ValueError:
+            background = pygame.transform.scale(background, size)
+
+        try:
+            atomic_write(file, (self.HEADER.pack(self.MAGIC, *size), pygame.image.tostring(background, "RGBX")))
+            self.evict()
+        except OSError as e:
+            print(f"Couldn't cache background {bg_path}: {e}")
+        return background
+
+    def evict(self):
+        evict_files(self.path, ".bg", self.max_size)
+
+
+def atomic_write(file, chunks):
+    """
+    Write the chunks next to the file and then swap it in, so an interrupted write never leaves a broken file behind.
+    """
+    with open(file + ".tmp", "wb") as f:
+        f.writelines(chunks)
+    os.replace(file + ".tmp", file)
+
+
+def evict_files(directory, extension, max_size):
+    """
+    Remove the least recently modified files with the extension until they take up at most `max_size` bytes.
+    """
+    entries = [(entry.stat(), entry.path) for entry in os.scandir(directory) if entry.name.endswith(extension)]
+    total = sum(stat.st_size for stat, _ in entries)
+    for stat, file in sorted(entries, key=lambda entry: entry[0].st_mtime):
+        if total <= max_size:
+            break
+        try:
+            os.remove(file)
+        except OSError:
+            # Still mapped somewhere on Windows
+            continue
+        total -= stat.st_size
+
+
+class PCMAudio:
+    """
+    Decoded audio memory mapped from a PCMCache file, in the mixer's format.
+    It's played in chunks of `CHUNK` ms, so starting anywhere only copies one chunk into a Sound.
+    """
+
+    CHUNK = 500
+
+    def __init__(self, file, header_size, frequency, channels, sample_size):
+        self.frequency = frequency
+        self.frame_size = channels * sample_size
+        with open(file, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self.mmap)[header_size:]
+        self.frames = len(self.data) // self.frame_size
+
+    @property
+    def length(self):
+        return self.frames / self.frequency * 1000
+
+    def get_frame(self, offset):
+        return min(max(0, round(offset * self.frequency / 1000)), self.frames)
+
+    def get_chunk(self, frame):
+        """
+        (Sound, frame after it) of the chunk starting at `frame`, None past the end.
+        """
+        if frame >= self.frames:
+            return
+        end = min(frame + self.CHUNK * self.frequency // 1000, self.frames)
+        chunk = self.data[frame * self.frame_size:end * self.frame_size]
+        sound = pygame.mixer.Sound(buffer=chunk)
+        chunk.release()
+        return sound, end
+
+    def close(self):
+        self.data.release()
+        self.mmap.close()
+
+
+class PCMCache:
+    """
+    Beatmap audio decoded to PCM in the mixer's format once and kept on disk, keyed by its path, mtime and
+    the mixer format. Files are a header followed by the samples and get memory mapped, so playback can start
+    from any sample without decoding. Audio that isn't cached yet is decoded in a separate thread.
+    The least recently used files are removed when the cache grows over `max_size` bytes.
+    """
+
+    HEADER = struct.Struct("<4siii")
+    MAGIC = b"CRPC"
+
+    def __init__(self, cache_path, max_size=512 * 1024 * 1024):
+        self.path = cache_path
+        self.max_size = max_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(cache_path, exist_ok=True)
+
+    def get_file(self, audio_path, mixer_format):
+        key = f"{path.abspath(audio_path)}|{os.stat(audio_path).st_mtime_ns}|{mixer_format}"
+        return path.join(self.path, hashlib.sha1(key.encode()).hexdigest() + ".pcm")
+
+    def get(self, audio_path):
+        """
+        Returns a future of the PCMAudio, which is already done if it was cached. The mixer has to be initialized.
+        """
+        future = Future()
+        try:
+            mixer_format = pygame.mixer.get_init()
+            file = self.get_file(audio_path, mixer_format)
+            audio = self.read(file, mixer_format)
+        except (OSError, pygame.error) as e:
+            future.set_exception(e)
+            return future
+        if audio is None:
+            return self.executor.submit(self.make, audio_path, mixer_format, file)
+        future.set_result(audio)
+        return future
+
+    def read(self, file, mixer_format):
+        if not path.exists(file):
+            return
+        with open(file, "rb") as f:
+            header = f.read(self.HEADER.size)
+        if len(header) != self.HEADER.size:
+            return
+        magic, frequency, sample_format, channels = self.HEADER.unpack(header)
+        if magic != self.MAGIC or (frequency, sample_format, channels) != tuple(mixer_format):
+            return
+        os.utime(file)
+        return PCMAudio(file, self.HEADER.size, frequency, channels, abs(sample_format) // 8)
+
+    def make(self, audio_path, mixer_format, file):
+        raw = pygame.mixer.Sound(audio_path).get_raw()
+        frequency, sample_format, channels = mixer_format
+        atomic_write(file, (self.HEADER.pack(self.MAGIC, frequency, sample_format, channels), raw))
+        evict_files(self.path, ".pcm", self.max_size)
+        return PCMAudio(file, self.HEADER.size, frequency, channels, abs(sample_format) // 8)
+
+
 class BeatmapResourceManager(BaseManager):
     """
     Manages all the resources of a beatmap such as background, custom skin elements, hit sounds, etc.
     """
 
     def __init__(self):
-        pass
+        self.path = None
+        self.entries = {}
+        self.files = {}
 
     def load_map(self):
-        pass
+        self.index_files()
@@ -0,0 +1,228 @@
+import re
+import bisect
+import numpy as np
+from collections import OrderedDict
+
+
+TOKEN = re.compile(r"\w+")
+FILTER = re.compile(r"^(\w+)(<=|>=|=|<|>)([\d.]+)$")
+
+
+class SearchIndex:
+    """
+    In-memory index of every difficulty in the library for song select.
+
+    Text search matches every word of the query as a prefix of a word in the artist, title, creator, version,
+    source or tags. Words are stored in a sorted vocabulary with the difficulties containing them stored back
+    to back in the same order, so all the difficulties of a prefix are one contiguous slice. Numeric fields are
+    NumPy columns that filters like `ar>9` or `length<=120` compare at once, and sorted views are a permutation
+    per sort key, so a query is a few vectorized operations over the library.
+
+    Difficulties added after the index was built are kept in a small separate word index until there
+    are enough of them to rebuild, removed ones are only masked out.
+    """
+
+    TEXT_FIELDS = ("artist", "title", "creator", "version", "source", "tags")
+    # Filter name: (attribute, multiplier from the value in the query to the stored one)
+    NUMERIC_FIELDS = {
+        "ar": ("approach_rate", 1),
+        "cs": ("circle_size", 1),
+        "od": ("overall_difficulty", 1),
+        "hp": ("hp_drain_rate", 1),
+        "length": ("length", 1000),  # s in queries, ms in the library
+        "stars": ("star_rating", 1),
+    }
+    SORT_KEYS = ("artist", "title", "creator", "version", "ar", "cs", "length", "stars")
+    # Rebuild once this share of the difficulties is in the separate index
+    REBUILD_AT = 0.1
+
+    def __init__(self, osu_cache, prefix_cache_size=256):
+        self.prefix_cache_size = prefix_cache_size
+        self.build(osu_cache.beatmapsets)
+
+    @classmethod
+    def get_tokens(cls, beatmap):
+        return set(TOKEN.findall(" ".join(getattr(beatmap, field) or "" for field in cls.TEXT_FIELDS).lower()))
+
+    @staticmethod
+    def get_value(beatmap, attribute):
+        value = getattr(beatmap, attribute, None)
+        return np.nan if value is None else value
+
+    @staticmethod
+    def get_text(beatmap, key):
+        return (getattr(beatmap, key) or "").lower()
+
+    def build(self, beatmapsets):
+        # Beatmapsets are kept so their ids can't be reused while they're indexed
+        self.beatmapsets = {}
+        self.beatmaps = []
+        for beatmapset in beatmapsets:
+            start = len(self.beatmaps)
+            self.beatmaps += beatmapset.beatmaps
+            self.beatmapsets[id(beatmapset)] = (beatmapset, range(start, len(self.beatmaps)))
+        self.ids = {id(beatmap): i for i, beatmap in enumerate(self.beatmaps)}
+        self.alive = np.ones(len(self.beatmaps), dtype=bool)
+
+        postings = {}
+        for i, beatmap in enumerate(self.beatmaps):
+            for token in self.get_tokens(beatmap):
+                postings.setdefault(token, []).append(i)
+        self.vocabulary = sorted(postings)
+        lengths = np.array([len(postings[token]) for token in self.vocabulary], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(lengths))) if len(lengths) else np.zeros(1, dtype=np.int64)
+        self.postings = np.fromiter((i for token in self.vocabulary for i in postings[token]),
+                                    dtype=np.int32, count=int(self.offsets[-1]))
+        self.extra_postings = {}
+        self.extra_count = 0
+
+        self.columns = {name: np.array([self.get_value(beatmap, attribute) for beatmap in self.beatmaps],
+                                       dtype=np.float64)
+                        for name, (attribute, _) in self.NUMERIC_FIELDS.items()}
+        # Sort key: difficulties in sorted order, and for text keys the sorted values to merge new ones into
+        self.orders = {}
+        self.sorted_texts = {}
+        self.prefixes = OrderedDict()
+
+    def sync(self, osu_cache):
+        """
+        Update the index after the library changed. OsuCache.update keeps the same BeatmapsetCache for every
+        beatmapset that didn't change, so only the ones that are new or gone are touched.
+        """
+        current = {id(beatmapset): beatmapset for beatmapset in osu_cache.beatmapsets}
+        removed = [key for key in self.beatmapsets if key not in current]
+        added = [beatmapset for key, beatmapset in current.items() if key not in self.beatmapsets]
+        if not removed and not added:
+            return
+        added_count = sum(len(beatmapset.beatmaps) for beatmapset in added)
+        if self.extra_count + added_count > self.REBUILD_AT * len(self.beatmaps):
+            return self.build(osu_cache.beatmapsets)
+
+        for key in removed:
+            _, ids = self.beatmapsets.pop(key)
+            self.alive[ids.start:ids.stop] = False
+            for i in ids:
+                del self.ids[id(self.beatmaps[i])]
+        start = len(self.beatmaps)
+        for beatmapset in added:
+            first = len(self.beatmaps)
+            self.beatmaps += beatmapset.beatmaps
+            self.beatmapsets[id(beatmapset)] = (beatmapset, range(first, len(self.beatmaps)))
+        new = self.beatmaps[start:]
+        self.alive = np.concatenate((self.alive, np.ones(len(new), dtype=bool)))
+        for i, beatmap in enumerate(new, start):
+            self.ids[id(beatmap)] = i
+            for token in self.get_tokens(beatmap):
+                self.extra_postings.setdefault(token, []).append(i)
+        self.extra_count += len(new)
+        for name, (attribute, _) in self.NUMERIC_FIELDS.items():
+            self.columns[name] = np.concatenate((self.columns[name], np.array(
+                [self.get_value(beatmap, attribute) for beatmap in new], dtype=np.float64)))
+
+        for key in list(self.orders):
+            if key in self.columns:
+                # Sorting a column again is quick
+                del self.orders[key]
+                continue
+            texts = sorted((self.get_text(beatmap, key), i) for i, beatmap in enumerate(new, start))
+            sorted_texts = self.sorted_texts[key]
+            positions = [bisect.bisect_right(sorted_texts, text) for text, _ in texts]
+            self.orders[key] = np.insert(self.orders[key], positions, [i for _, i in texts])
+            merged, last = [], 0
+            for position, (text, _) in zip(positions, texts):
+                merged += sorted_texts[last:position]
+                merged.append(text)
+                last = position
+            self.sorted_texts[key] = merged + sorted_texts[last:]
+        self.prefixes.clear()
+
+    def set_value(self, beatmap, name, value):
+        """
+        Change a numeric field of a difficulty, like its star rating once it's calculated.
+        """
+        i = self.ids.get(id(beatmap))
+        if i is None:
+            return
+        self.columns[name][i] = value
+        self.orders.pop(name, None)
+
+    def match_prefix(self, prefix):
+        """
+        Mask of the difficulties with a word starting with `prefix`.
+        """
+        mask = self.prefixes.get(prefix)
+        if mask is not None:
+            self.prefixes.move_to_end(prefix)
+            return mask
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        # Every word starting with the prefix sorts before the prefix followed by the highest character
+        end = bisect.bisect_left(self.vocabulary, prefix + "\U0010ffff", start)
+        mask = np.zeros(len(self.beatmaps), dtype=bool)
+        mask[self.postings[self.offsets[start]:self.offsets[end]]] = True
+        for token, ids in self.extra_postings.items():
+            if token.startswith(prefix):
+                mask[ids] = True
+
+        self.prefixes[prefix] = mask
+        if len(self.prefixes) > self.prefix_cache_size:
+            self.prefixes.popitem(last=False)
+        return mask
+
+    def get_order(self, key):
+        order = self.orders.get(key)
+        if order is None:
+            if key in self.columns:
+                # NaN sorts last
+                order = np.argsort(self.columns[key], kind="stable")
+            else:
+                texts = [self.get_text(beatmap, key) for beatmap in self.beatmaps]
+                order = np.array(sorted(range(len(texts)), key=texts.__getitem__), dtype=np.int64)
+                self.sorted_texts[key] = [texts[i] for i in order]
+            self.orders[key] = order
+        return order
+
+    def parse_query(self, query):
+        """
+        Returns the words and the (field, operator, value) filters of a query.
+        """
+        words, filters = [], []
+        for part in query.lower().split():
+            match = FILTER.match(part)
+            if match is not None and match.group(1) in self.NUMERIC_FIELDS:
+                try:
+                    filters.append((match.group(1), match.group(2), float(match.group(3))))
+                    continue
+                except ValueError:
+                    pass
+            words += TOKEN.findall(part)
+        return words, filters
+
+    def search(self, query, sort_key="artist", descending=False):
+        """
+        Indices into `beatmaps` of the difficulties matching the query, sorted by `sort_key`.
+        """
+        words, filters = self.parse_query(query)
+        mask = self.alive
+        for word in words:
+            mask = mask & self.match_prefix(word)
+        for field, operator, value in filters:
+            column = self.columns[field]
+            value *= self.NUMERIC_FIELDS[field][1]
+            if operator == "=":
+                # Lengths are compared to the second, everything else to the shown precision
+                tolerance = 500 if field == "length" else 0.05
+                mask = mask & (np.abs(column - value) < tolerance)
+            elif operator == "<":
+                mask = mask & (column < value)
+            elif operator == "<=":
+                mask = mask & (column <= value)
+            elif operator == ">":
+                mask = mask & (column > value)
+            else:
+                mask = mask & (column >= value)
+        order = self.get_order(sort_key)
+        results = order[mask[order]]
+        return results[::-1] if descending else results
+
+    def get(self, results, i):
+        return self.beatmaps[results[i]]
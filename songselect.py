@@ -1,11 +1,96 @@
+import time
+import pygame
 from game import BaseState
+from loading import BeatmapLoader
+from search import SearchIndex
 
 
 class SongSelect(BaseState):
+    """
+    Type to search the library, filters like `ar>9`, `cs<=4`, `length<120` (seconds) or `stars>=5` narrow
+    it down. Tab switches what the results are sorted by, shift+tab reverses it, F5 rescans the songs folder.
+    """
+
+    ROWS = 20
+
     def __init__(self, game):
         self.game = game
+        self.screen = game.screen
+        self.size = self.screen.get_size()
+        self.resources = game.resources
 
         self.songs_folder = game.songs_folder
+        if game.search_index is None:
+            game.search_index = SearchIndex(self.songs_folder)
+        self.index = game.search_index
+
+        self.query = ""
+        self.sort_key = "artist"
+        self.descending = False
+        self.cursor = 0
+        self.search_time = 0
+        self.search()
+
+    def search(self):
+        start = time.perf_counter()
+        self.results = self.index.search(self.query, self.sort_key, self.descending)
+        self.search_time = (time.perf_counter() - start) * 1000
+        self.cursor = min(self.cursor, max(0, len(self.results) - 1))
+
+    def refresh(self):
+        if self.songs_folder.update():
+            self.songs_folder.to_file(self.game.config.get("library_path"))
+        # Gives the beatmaps their star rating first so the index picks them up
+        self.game.star_ratings.start(self.songs_folder)
+        self.index.sync(self.songs_folder)
+        self.search()
+
+    def handle_event(self, event):
+        if event.type == pygame.TEXTINPUT:
+            self.query += event.text
+            self.cursor = 0
+            self.search()
+        elif event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_BACKSPACE and self.query:
+                self.query = self.query[:-1]
+                self.search()
+            elif event.key == pygame.K_TAB:
+                if event.mod & pygame.KMOD_SHIFT:
+                    self.descending = not self.descending
+                else:
+                    keys = SearchIndex.SORT_KEYS
+                    self.sort_key = keys[(keys.index(self.sort_key) + 1) % len(keys)]
+                self.search()
+            elif event.key in (pygame.K_UP, pygame.K_DOWN, pygame.K_PAGEUP, pygame.K_PAGEDOWN):
+                step = {pygame.K_UP: -1, pygame.K_DOWN: 1, pygame.K_PAGEUP: -self.ROWS, pygame.K_PAGEDOWN: self.ROWS}
+                self.cursor = max(0, min(len(self.results) - 1, self.cursor + step[event.key]))
+            elif event.key == pygame.K_F5:
+                self.refresh()
+            elif event.key == pygame.K_RETURN and len(self.results):
+                self.game.switch_state("loading", BeatmapLoader(self.game, self.index.get(self.results, self.cursor)))
+            elif event.key == pygame.K_ESCAPE:
+                self.game.switch_state("start")
 
     def draw(self):
-        pass
+        text, font = self.resources.text, self.resources.font
+        white, grey = (255, 255, 255), (150, 150, 150)
+        line_height = font.get_height() + 4
+        self.screen.fill((0, 0, 0))
+
+        text.draw(self.screen, font, "Search: ", white, (8, 8), self.query)
+        order = "descending" if self.descending else "ascending"
+        text.draw(self.screen, font, f"{len(self.results)} results by {self.sort_key}, {order} - search ms: ", grey,
+                  (8, 8 + line_height), f"{self.search_time:.2f}")
+        star_ratings = self.game.star_ratings
+        if star_ratings.progress < 1:
+            text.draw(self.screen, font, f"Calculating {star_ratings.total} star ratings, done: ", grey,
+                      (8, 8 + line_height * 2), str(star_ratings.done))
+
+        first = max(0, min(self.cursor - self.ROWS // 2, len(self.results) - self.ROWS))
+        for row, i in enumerate(range(first, min(first + self.ROWS, len(self.results)))):
+            beatmap = self.index.get(self.results, i)
+            stars = "?" if beatmap.star_rating is None else f"{beatmap.star_rating:.2f}"
+            text.draw(self.screen, font, f"{beatmap.artist} - {beatmap.title} [{beatmap.version}] {stars}*"
+                                         f" AR{beatmap.approach_rate:g} CS{beatmap.circle_size:g}"
+                                         f" {beatmap.length // 60000}:{beatmap.length // 1000 % 60:02d}",
+                      white if i == self.cursor else grey, (8, 8 + line_height * (row + 3)))
@@ -0,0 +1,194 @@
+import os
+import math
+import struct
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, CancelledError, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from osu_sr_calculator import calculateStarRating
+
+
+def calculate(beatmap_path):
+    """
+    NoMod star rating of a .osu file, NaN if it can't be calculated (like for other modes).
+    Runs in the worker processes.
+    """
+    try:
+        return float(calculateStarRating(filepath=beatmap_path)["nomod"])
+    except Exception as e:
+        print(f"Couldn't calculate the star rating of {beatmap_path}: {e}")
+        return math.nan
+
+
+def init_worker():
+    # Stay out of the way of the game itself
+    if hasattr(os, "nice"):
+        os.nice(10)
+
+
+def hash_file(beatmap_path):
+    with open(beatmap_path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+class StarRatingCache:
+    """
+    NoMod star ratings by the MD5 of the .osu file, calculated for the whole library by a process pool
+    in the background. Every rating is appended to the file as soon as it's calculated, so stopping halfway
+    only loses the ones that were being calculated and the next run picks up from there.
+    Finished ratings are handed to the main thread by update(). Workers are spawned rather than forked,
+    so they don't inherit the game's threads and display.
+    """
+
+    RECORD = struct.Struct("<16sf")
+
+    def __init__(self, cache_path, workers=None):
+        self.path = cache_path
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.ratings = self.load()
+        self.executor = None
+        self.thread = None
+        # Set to stop the run that's going, every run gets its own
+        self.stopped = threading.Event()
+        # Guards ratings, finished and done, which the run thread adds to
+        self.lock = threading.Lock()
+        # Beatmaps by MD5 of the ones being calculated
+        self.pending = {}
+        self.finished = deque()
+        self.total = 0
+        self.done = 0
+
+    def load(self):
+        ratings = {}
+        if not os.path.exists(self.path):
+            return ratings
+        with open(self.path, "rb") as f:
+            data = f.read()
+        # A record cut off by the game being stopped while it was written is dropped
+        end = len(data) - len(data) % self.RECORD.size
+        for md5, rating in self.RECORD.iter_unpack(data[:end]):
+            ratings[md5.hex()] = rating
+        if end != len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+        return ratings
+
+    def get(self, md5):
+        """
+        The star rating of the .osu file with this MD5, or None if it isn't known (yet).
+        """
+        with self.lock:
+            rating = self.ratings.get(md5)
+        return None if rating is None or math.isnan(rating) else rating
+
+    def get_file(self, beatmap_path):
+        try:
+            return self.get(hash_file(beatmap_path))
+        except OSError:
+            return
+
+    def apply(self, beatmaps):
+        """
+        Set `star_rating` of the BeatmapCaches that already have one, returns the ones that don't.
+        """
+        missing = []
+        with self.lock:
+            ratings = dict(self.ratings)
+        for beatmap in beatmaps:
+            if beatmap.md5 in ratings:
+                rating = ratings[beatmap.md5]
+                beatmap.star_rating = None if math.isnan(rating) else rating
+            else:
+                beatmap.star_rating = None
+                missing.append(beatmap)
+        return missing
+
+    def start(self, osu_cache):
+        """
+        Calculate the star ratings that aren't known for every beatmap of the library.
+        """
+        self.stop()
+        self.pending = {}
+        for beatmap in self.apply(beatmap for beatmapset in osu_cache.beatmapsets
+                                  for beatmap in beatmapset.beatmaps):
+            self.pending.setdefault(beatmap.md5, []).append(beatmap)
+        with self.lock:
+            self.total, self.done = len(self.pending), 0
+        if not self.pending:
+            return
+        print(f"Calculating {self.total} star ratings in the background...")
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.stopped = threading.Event()
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=init_worker)
+        self.thread = threading.Thread(target=self.run,
+                                       args=(self.executor, list(self.pending.items()), self.stopped),
+                                       name="star-ratings", daemon=True)
+        self.thread.start()
+
+    def run(self, executor, jobs, stopped):
+        # Only a few beatmaps are handed to the pool at a time, so stopping doesn't wait for a long queue
+        jobs = iter(jobs)
+        running = {}
+        try:
+            with open(self.path, "ab") as f:
+                while not stopped.is_set():
+                    while len(running) < self.workers * 2:
+                        job = next(jobs, None)
+                        if job is None:
+                            break
+                        md5, beatmaps = job
+                        running[executor.submit(calculate, beatmaps[0].path)] = md5
+                    if not running:
+                        print("Star ratings calculated.")
+                        break
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        md5 = running.pop(future)
+                        rating = future.result()
+                        with self.lock:
+                            # A run that got stopped leaves the next one alone
+                            if stopped.is_set():
+                                break
+                            f.write(self.RECORD.pack(bytes.fromhex(md5), rating))
+                            f.flush()
+                            self.ratings[md5] = rating
+                            self.finished.append(md5)
+                            self.done += 1
+        # Submitting after stop() shut the pool down raises RuntimeError
+        except (CancelledError, BrokenProcessPool, RuntimeError):
+            pass
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def progress(self):
+        with self.lock:
+            return self.done / self.total if self.total else 1
+
+    def update(self, search_index=None):
+        """
+        Give the beatmaps whose star rating got calculated since the last call their rating,
+        and update it in the search index. Called from the main thread.
+        """
+        with self.lock:
+            finished, self.finished = self.finished, deque()
+        for md5 in finished:
+            rating = self.get(md5)
+            for beatmap in self.pending.pop(md5, ()):
+                beatmap.star_rating = rating
+                if search_index is not None:
+                    search_index.set_value(beatmap, "stars", math.nan if rating is None else rating)
+
+    def stop(self):
+        """
+        Stop calculating, what's calculated so far is kept. The workers finish the beatmaps they already got.
+        """
+        if self.executor is None:
+            return
+        self.stopped.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
@@ -1,6 +1,7 @@
 import pygame
 import random
 from game import BaseState
+from loading import BeatmapLoader
 
 
 class StartScreen(BaseState):
@@ -14,6 +15,8 @@ class StartScreen(BaseState):
 
         self.pekora_angle = 0
         self.status_message = ""
+        # The next random beatmap is loaded in the background so it starts right away
+        self.next_beatmap = self.prefetch()
 
     def get_random_beatmapset(self):
         return random.choice(self.songs_folder.beatmapsets)
@@ -21,6 +24,11 @@ class StartScreen(BaseState):
     def get_random_beatmap(self):
         return random.choice(self.get_random_beatmapset().beatmaps)
 
+    def prefetch(self):
+        if not self.songs_folder.beatmapsets:
+            return
+        return BeatmapLoader(self.game, self.get_random_beatmap())
+
     def get_testing_map(self):
         for beatmapset in self.songs_folder.beatmapsets:
             for beatmap in beatmapset.beatmaps:
@@ -30,11 +38,24 @@ class StartScreen(BaseState):
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN:
             if event.key == pygame.K_r:
-                self.game.switch_state("play", self.get_random_beatmap())
+                loader = self.next_beatmap or BeatmapLoader(self.game, self.get_random_beatmap())
+                self.next_beatmap = None
+                self.game.switch_state("loading", loader)
+            elif event.key == pygame.K_RETURN:
+                self.cancel_prefetch()
+                self.game.switch_state("select")
 
     def handle_state(self):
         self.rotate_pekora()
 
+    def cancel_prefetch(self):
+        if self.next_beatmap is not None:
+            self.next_beatmap.cancel()
+            self.next_beatmap = None
+
+    def on_quit(self):
+        self.cancel_prefetch()
+
     def rotate_pekora(self):
         self.pekora_angle += 1
         if self.pekora_angle > 360:
@@ -46,13 +67,14 @@ class StartScreen(BaseState):
         self.draw_fps()
 
     def draw_fps(self):
-        fps_render = self.resources.font.render(
-            f'FPS: {round(self.clock.get_fps())}', True, (255, 255, 255))
-        self.screen.blit(fps_render, (self.size[0] - fps_render.get_width() - 4,
-                                      self.size[1] - fps_render.get_height() - 4))
+        text, font = self.resources.text, self.resources.font
+        fps = str(round(self.clock.get_fps()))
+        width = text.get_width(font, 'FPS: ', (255, 255, 255), fps)
+        text.draw(self.screen, font, 'FPS: ', (255, 255, 255),
+                  (self.size[0] - width - 4, self.size[1] - font.get_height() - 4), fps)
 
     def draw_pekora(self):
-        rotated_image = pygame.transform.rotate(self.resources.pekora, self.pekora_angle)
+        rotated_image = self.resources.transforms.get(self.resources.pekora, self.pekora_angle)
         if self.status_message:
             pekora_status = self.resources.pekora_font.render(
                 self.status_message, True, (255, 255, 255))
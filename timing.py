@@ -0,0 +1,175 @@
+import time
+import numpy as np
+import pygame
+
+
+class FrameTimer:
+    """
+    Records how long every stage of a frame took in a ring buffer of the last `history` frames.
+    Call start_frame at the beginning of a frame, mark after each stage and end_frame at the end.
+    """
+
+    enabled = True
+    STAGES = ("events", "state", "background", "objects", "draw", "display")
+    COLORS = ((200, 200, 200), (255, 200, 0), (80, 160, 255), (255, 80, 80), (160, 255, 120), (200, 120, 255))
+
+    def __init__(self, history=600):
+        self.history = history
+        self.stage_indices = {stage: i for i, stage in enumerate(self.STAGES)}
+        # One column per stage, times in ms
+        self.times = np.zeros((history, len(self.STAGES)), dtype=np.float32)
+        self.frame = 0
+        self.last = time.perf_counter()
+        # The surface make_graph draws on, and the frame it was drawn up to
+        self.graph = None
+        self.graph_frame = 0
+
+    def start_frame(self):
+        self.times[self.frame % self.history] = 0
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.times[self.frame % self.history, self.stage_indices[stage]] += (now - self.last) * 1000
+        self.last = now
+
+    def end_frame(self):
+        self.frame += 1
+
+    def get_times(self):
+        """
+        The recorded frames from oldest to newest.
+        """
+        if self.frame < self.history:
+            return self.times[:self.frame]
+        return np.roll(self.times, -(self.frame % self.history), axis=0)
+
+    def dump_csv(self, path):
+        times = self.get_times()
+        first = self.frame - len(times)
+        with open(path, "w") as f:
+            f.write(",".join(("frame",) + self.STAGES + ("total",)) + "\n")
+            for i, row in enumerate(times):
+                f.write(",".join([str(first + i)] + [f"{t:.3f}" for t in row] + [f"{row.sum():.3f}"]) + "\n")
+        print(f"Frame times written to {path}")
+
+    def get_means(self, frames=30):
+        """
+        Mean time of every stage over the most recent frames, zeros before the first frame.
+        """
+        count = min(frames, self.frame, self.history)
+        if count == 0:
+            return np.zeros(len(self.STAGES), dtype=np.float32)
+        rows = np.arange(self.frame - count, self.frame) % self.history
+        return self.times[rows].mean(axis=0)
+
+    def make_graph(self, size, ms_range=1000/30):
+        """
+        Stacked graph of the stage times of the most recent frames, one pixel column per frame.
+        The line marks 60 fps. The same surface is kept and scrolled, only the frames since the last call get drawn.
+        """
+        width, height = size
+        if self.graph is None or self.graph.get_size() != size:
+            self.graph = pygame.Surface(size)
+            self.graph.fill((0, 0, 0))
+            self.graph_frame = self.frame - width
+        first = max(self.graph_frame, self.frame - width, self.frame - self.history, 0)
+        new = self.frame - self.graph_frame
+        if new > 0:
+            self.graph.scroll(-min(new, width), 0)
+            self.graph.fill((0, 0, 0), (max(0, width - new), 0, min(new, width), height))
+            for frame in range(first, self.frame):
+                x = width - (self.frame - frame)
+                bottom = height
+                total = 0
+                for color, stage_time in zip(self.COLORS, self.times[frame % self.history]):
+                    total += stage_time
+                    top = height - min(height, round(total / ms_range * height))
+                    if top < bottom:
+                        self.graph.fill(color, (x, top, 1, bottom - top))
+                        bottom = top
+            self.graph_frame = self.frame
+        line_y = height - 1 - round(1000 / 60 / ms_range * height)
+        self.graph.fill((255, 255, 255), (0, line_y, width, 1))
+        return self.graph
+
+
+class PlaybackClock:
+    """
+    Gameplay time in ms, following the music when it's playing. It runs on a monotonic timer so it moves
+    smoothly between frames, and every update part of the difference to the mixer's position (minus the
+    output `latency`) is corrected, so it can't drift away from the audio. Differences over `SNAP` ms,
+    like when the audio starts, are jumped over instead.
+    `time_source` returns seconds, the drift of the last `history` updates is kept for the debug overlay.
+    """
+
+    CORRECTION = 0.05
+    SNAP = 100
+
+    def __init__(self, audio_manager, latency=0, time_source=time.perf_counter, history=600):
+        self.audio_manager = audio_manager
+        self.latency = latency
+        self.time_source = time_source
+        self.offset = 0
+        self.last_time = time_source()
+        self.history = history
+        self.drifts = np.zeros(history, dtype=np.float32)
+        self.updates = 0
+
+    def seek(self, offset):
+        self.offset = offset
+        self.last_time = self.time_source()
+
+    def update(self):
+        now = self.time_source()
+        offset = self.offset + (now - self.last_time) * 1000
+        self.last_time = now
+        audio_offset = self.audio_manager.get_position()
+        if audio_offset is not None:
+            drift = audio_offset - self.latency - offset
+            self.drifts[self.updates % self.history] = drift
+            self.updates += 1
+            if abs(drift) > self.SNAP:
+                offset += drift
+            else:
+                # The mixer position moves in steps of its buffer size, following it slowly smooths that out.
+                # Time still never goes backwards
+                offset = max(self.offset, offset + drift * self.CORRECTION)
+        self.offset = offset
+        return offset
+
+    def get_drift_stats(self):
+        """
+        (last, mean, max absolute) drift between the audio and the clock in ms before correcting it,
+        None before the audio started.
+        """
+        if self.updates == 0:
+            return
+        drifts = self.drifts[:min(self.updates, self.history)]
+        return float(self.drifts[(self.updates - 1) % self.history]), float(drifts.mean()), float(np.abs(drifts).max())
+
+
+class NullFrameTimer:
+    """
+    Used when frame timing is disabled so the hooks cost next to nothing.
+    """
+
+    enabled = False
+
+    def start_frame(self):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def end_frame(self):
+        pass
+
+    def dump_csv(self, path):
+        pass
+
+
+def make_frame_timer(config):
+    if not config.get("profiling.enabled"):
+        return NullFrameTimer()
+    return FrameTimer(config.get("profiling.history"))
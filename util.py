@@ -1,8 +1,15 @@
 from constants import osu_pixel_window
-from enums import SkinOption
+from enums import SkinOption, ObjectKind, RenderState
 from beatmap_reader import HitObjectType
+from resource import get_surface_size
 import math
 import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+SLIDERBALL_STEP = 2  # ms between precomputed slider ball positions
 
 
 class ResolutionManager:
@@ -51,80 +58,338 @@ class ResolutionManager:
 
 
 class ObjectManager:
-    def __init__(self, beatmap, resolution, resources):
-        self.hit_object_combo_colors = {}
-        self.hit_object_combos = []
+    def __init__(self, beatmap, resolution, resources, config):
         ar = float(beatmap.difficulty.approach_rate)
         self.preempt = 1200 + 600 * (5 - ar) / 5 if ar < 5 else 1200 - 750 * (ar - 5) / 5
         self.fadein = 800 + 400 * (5 - ar) / 5 if ar < 5 else 800 - 500 * (ar - 5) / 5
-        self.hit_objects = list(beatmap.hit_objects)  # new list object
-        self.obj_offset = 0
-        threading.Thread(target=self._do_hit_object_load, args=(resources, resolution)).start()
+        self.hit_objects = sorted(beatmap.hit_objects, key=lambda hit_object: hit_object.time)  # new list object
+        self.build_time_index()
+        self.build_render_attributes(resolution, resources.skin.config)
+        self.build_sliderball_table(resolution)
+        self.sliders = SliderRenderer(self, resolution, resources.skin.config,
+                                      config.get("rendering.slider_render_ahead"),
+                                      config.get("rendering.slider_cache_size") * 1024 * 1024,
+                                      config.get("rendering.slider_render_workers"))
+
+    def build_time_index(self):
+        """
+        Index the start, end and visible-from times of the hit objects so finding the objects
+        for any offset is a binary search, whether playback moves forward or backward.
+        """
+        self.start_times = np.array([hit_object.time for hit_object in self.hit_objects], dtype=np.float64)
+        self.end_times = np.array([getattr(hit_object, "end_time", hit_object.time)
+                                   for hit_object in self.hit_objects], dtype=np.float64)
+        self.visible_from_times = self.start_times - self.preempt
+        # Time at which an object reaches full opacity
+        self.clear_times = self.visible_from_times + self.fadein
+        # End times aren't sorted when a long object overlaps the next ones, their running maximum is
+        self.max_end_times = np.maximum.accumulate(self.end_times) if len(self.end_times) else self.end_times
 
-    def _do_hit_object_load(self, resources, resolution):
-        main_thread = threading.current_thread()
-        config = resources.skin.config
+    def build_render_attributes(self, resolution, config):
+        """
+        Precompute what drawing needs for each object into arrays indexed by the object's position
+        in hit_objects, so the draw path never has to search for an object.
+        """
+        count = len(self.hit_objects)
+        self.kinds = np.empty(count, dtype=np.int8)
+        self.combo_numbers = np.empty(count, dtype=np.int32)
+        self.combo_colors = np.empty(count, dtype=np.int8)
         current_combo_color = 0
         current_combo = 1
         for i, hit_object in enumerate(self.hit_objects):
-            if not main_thread.is_alive():
-                return print("Hit object loading thread killed itself D:")
-
             if hit_object.new_combo:
                 current_combo_color = (current_combo_color + 1) % len(config.combo_colors)
                 current_combo = 1
-            self.hit_object_combo_colors[hit_object] = current_combo_color
-            self.hit_object_combos.append(current_combo)
-            if hit_object.type != HitObjectType.SPINNER:
+            self.combo_colors[i] = current_combo_color
+            self.combo_numbers[i] = current_combo
+            if hit_object.type == HitObjectType.SPINNER:
+                self.kinds[i] = ObjectKind.SPINNER
+            else:
+                self.kinds[i] = ObjectKind.SLIDER if hit_object.type == HitObjectType.SLIDER else ObjectKind.CIRCLE
                 current_combo += 1
 
-            if hit_object.type == HitObjectType.SLIDER:
-                color = config.combo_colors[current_combo_color] \
-                    if config.slider_track_override == SkinOption.CURRENT_COMBO_COLOR \
-                    else config.slider_track_color
-                hit_object.render(resolution.screen_size, resolution.actual_placement_offset,
-                                  resolution.osu_pixel_multiplier, color, config.slider_border,
-                                  round(5*resolution.osu_pixel_multiplier))
-        print("Finished loading all hit objects!")
+        stacked_positions = np.array([hit_object.stacked_position for hit_object in self.hit_objects],
+                                     dtype=np.float32).reshape(count, 2)
+        self.positions = stacked_positions * resolution.osu_pixel_multiplier + \
+            np.array(resolution.actual_placement_offset, dtype=np.float32) - resolution.object_size // 2
+
+    def get_hit_object_window(self, offset):
+        """
+        Returns the (start, end) index range of the objects that can be visible at the offset.
+        """
+        start = int(np.searchsorted(self.max_end_times, offset, "left"))
+        end = int(np.searchsorted(self.visible_from_times, offset, "right"))
+        return start, max(start, end)
+
+    def get_indices_for_offset(self, offset):
+        start, end = self.get_hit_object_window(offset)
+        # Reversed so earlier objects are drawn on top
+        return [i for i in range(end - 1, start - 1, -1) if self.end_times[i] >= offset]
 
     def get_hit_objects_for_offset(self, offset):
-        index = self.obj_offset
-        objects = []
-        while True:
-            if index == len(self.hit_objects):
-                break
-            end_time = self.hit_objects[index].end_time if hasattr(self.hit_objects[index], "end_time") \
-                else self.hit_objects[index].time
-            if offset > end_time:
-                self.obj_offset += 1
-                index += 1
-                continue
-            if offset < self.hit_objects[index].time-self.preempt:
-                break
-            index += 1
-            objects.append(self.hit_objects[index-1])
-        objects.reverse()
-        return objects
-
-    def get_opacity(self, hit_object, offset):
-        # Time at which circle becomes 100% opacity
-        clear = hit_object.time - self.preempt + self.fadein
+        return [self.hit_objects[i] for i in self.get_indices_for_offset(offset)]
+
+    def get_opacity(self, index, offset):
+        clear = self.clear_times[index]
         return 200 if offset >= clear else 200 - round(
             (clear - offset) / self.fadein * 200)
 
-    def get_combo_color(self, hit_object):
-        return self.hit_object_combo_colors[hit_object]
+    def get_combo_color(self, index):
+        return int(self.combo_colors[index])
+
+    def get_combo_number(self, index):
+        return int(self.combo_numbers[index])
+
+    def get_position(self, index):
+        x, y = self.positions[index]
+        return float(x), float(y)
+
+    def get_ac_multiplier(self, index, offset):
+        return (self.start_times[index] - offset) / self.preempt * 2 + 1
+
+    def build_sliderball_table(self, resolution, step=SLIDERBALL_STEP):
+        """
+        Precompute the screen position of the slider ball every `step` ms of every slider, repeats included.
+        The positions of all sliders are stored back to back in one array, sliderball_starts[i] is
+        where the positions of object i start.
+        """
+        count = len(self.hit_objects)
+        self.sliderball_step = step
+        self.sliderball_starts = np.full(count, -1, dtype=np.int64)
+        self.sliderball_counts = np.zeros(count, dtype=np.int64)
+        tables = []
+        total = 0
+        for i in np.flatnonzero(self.kinds == ObjectKind.SLIDER):
+            hit_object = self.hit_objects[i]
+            points = np.asarray(hit_object.curve.curve_points, dtype=np.float64).reshape(-1, 2)
+            if len(points) == 0:
+                points = np.array([hit_object.stacked_position], dtype=np.float64)
+            points = points + np.subtract(hit_object.stacked_position,
+                                          getattr(hit_object, "position", hit_object.stacked_position))
+            # Distance along the path at each curve point, so the ball moves at a constant speed
+            # even if the curve points aren't evenly spaced
+            distances = np.concatenate(([0], np.cumsum(np.hypot(*np.diff(points, axis=0).T))))
+            duration = max(self.end_times[i] - self.start_times[i], 1)
+            slides = max(hit_object.slides, 1)
+            times = np.arange(0, duration + step, step, dtype=np.float64)
+            # Progress along the path, going back and forth on every repeat
+            progress = np.minimum(times / duration, 1) * slides % 2
+            progress = np.where(progress > 1, 2 - progress, progress)
+            if slides % 2 == 0:
+                progress[-1] = 0  # Ends where it started
+            along = progress * distances[-1]
+            table = np.column_stack((np.interp(along, distances, points[:, 0]),
+                                     np.interp(along, distances, points[:, 1])))
+            tables.append(table)
+            self.sliderball_starts[i] = total
+            self.sliderball_counts[i] = len(table)
+            total += len(table)
+
+        table = np.concatenate(tables) if tables else np.empty((0, 2))
+        self.sliderball_positions = (table * resolution.osu_pixel_multiplier +
+                                     resolution.actual_placement_offset -
+                                     resolution.object_size // 2).astype(np.float32)
+
+    def get_sliderball_position(self, index, offset):
+        sample = int((offset - self.start_times[index]) // self.sliderball_step)
+        sample = min(max(sample, 0), self.sliderball_counts[index] - 1)
+        x, y = self.sliderball_positions[self.sliderball_starts[index] + sample]
+        return float(x), float(y)
+
+    def get_sliderball_positions(self, indices, offsets):
+        """
+        Slider ball positions of many sliders and offsets at once, `indices` and `offsets` are broadcast together.
+        """
+        indices = np.asarray(indices)
+        samples = ((np.asarray(offsets) - self.start_times[indices]) // self.sliderball_step).astype(np.int64)
+        samples = np.clip(samples, 0, self.sliderball_counts[indices] - 1)
+        return self.sliderball_positions[self.sliderball_starts[indices] + samples]
+
 
-    def get_combo_number(self, hit_object):
-        return self.hit_object_combos[self.hit_objects.index(hit_object)]
+class SliderRenderer:
+    """
+    Schedules slider bodies to be rendered in a worker pool into surfaces cropped to their bounding box.
+    Only sliders that become visible within `render_ahead` ms of the current offset are rendered,
+    earliest first, and rendered bodies are kept in a least recently used cache limited to `max_size` bytes.
+
+    No more jobs than there are workers are in flight at once, so the next slider is always
+    picked from the current offset, even after seeking.
+    """
+
+    def __init__(self, object_manager, resolution, config, render_ahead=5000, max_size=256 * 1024 * 1024,
+                 workers=2):
+        self.object_manager = object_manager
+        self.resolution = resolution
+        self.config = config
+        self.render_ahead = render_ahead
+        self.max_size = max_size
+        self.workers = workers
+
+        self.is_slider = object_manager.kinds == ObjectKind.SLIDER
+        self.states = np.full(len(object_manager.hit_objects), RenderState.NONE, dtype=np.int8)
+        self.bounds = {}
+        self.placeholders = {}
+        self.surfaces = OrderedDict()
+        self.size = 0
+        self.in_flight = 0
+        self.pending = {}
+        self.lock = threading.RLock()
+        self.rendered = threading.Condition(self.lock)
+
+        self.offset = -math.inf
+        self.running = True
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="slider-render")
+
+    def get_bounds(self, hit_object):
+        """
+        Screen space (x, y, width, height) of the area a slider body covers.
+        """
+        resolution = self.resolution
+        points = np.asarray(hit_object.curve.curve_points, dtype=np.float64).reshape(-1, 2)
+        if len(points) == 0:
+            return (0, 0) + tuple(resolution.screen_size)
+        # Stacking moves the body a little, make room for it instead of guessing which way
+        stack_offset = np.subtract(hit_object.stacked_position,
+                                   getattr(hit_object, "position", hit_object.stacked_position))
+        margin = resolution.object_size / 2 + round(5*resolution.osu_pixel_multiplier) + 2 + \
+            np.abs(stack_offset).max() * resolution.osu_pixel_multiplier
+        points = points * resolution.osu_pixel_multiplier + resolution.actual_placement_offset
+        x1, y1 = np.maximum(np.floor(points.min(axis=0) - margin), 0).astype(int)
+        x2, y2 = np.minimum(np.ceil(points.max(axis=0) + margin), resolution.screen_size).astype(int)
+        return int(x1), int(y1), max(1, int(x2 - x1)), max(1, int(y2 - y1))
+
+    def update(self, offset):
+        self.offset = offset
+        self.dispatch()
+
+    def stop(self):
+        """
+        Cancel all queued work, a body that is being rendered right now is thrown away when it's done.
+        """
+        with self.lock:
+            self.running = False
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def is_ready(self, index):
+        return self.states[index] == RenderState.READY
+
+    def wait_for_visible(self, offset, timeout=None):
+        """
+        Block until every slider visible at the offset is rendered, returns False on timeout.
+        """
+        self.update(offset)
+        start, end = self.object_manager.get_hit_object_window(offset)
+        visible = [i for i in range(start, end) if self.is_slider[i] and self.object_manager.end_times[i] >= offset]
+        with self.rendered:
+            return self.rendered.wait_for(
+                lambda: not self.running or all(self.states[i] >= RenderState.READY for i in visible), timeout)
+
+    def get(self, index):
+        """
+        Returns the rendered body of a slider and where to blit it, or (None, None) if it's not ready yet.
+        """
+        with self.lock:
+            surf = self.surfaces.get(index)
+            if surf is None:
+                return None, None
+            self.surfaces.move_to_end(index)
+        return surf, self.bounds[index][:2]
+
+    def get_placeholder(self, index):
+        """
+        Screen space points of a slider's path, cheap to draw while the body isn't ready.
+        """
+        points = self.placeholders.get(index)
+        if points is None:
+            curve_points = np.asarray(self.object_manager.hit_objects[index].curve.curve_points,
+                                      dtype=np.float64).reshape(-1, 2)
+            points = self.placeholders[index] = (curve_points * self.resolution.osu_pixel_multiplier +
+                                                 self.resolution.actual_placement_offset).tolist()
+        return points
+
+    def get_window(self, offset):
+        object_manager = self.object_manager
+        start, end = object_manager.get_hit_object_window(offset)
+        end_ahead = int(np.searchsorted(object_manager.visible_from_times, offset + self.render_ahead, "right"))
+        return start, end, max(end, end_ahead)
+
+    def dispatch(self):
+        """
+        Submit the earliest sliders of the render-ahead window that aren't rendered yet until every worker is busy.
+        Visible sliders are always submitted, the ones ahead only if they fit in the budget.
+        """
+        with self.lock:
+            if not self.running:
+                return
+            offset = self.offset
+            object_manager = self.object_manager
+            start, end, end_ahead = self.get_window(offset)
+            for i in range(start, end_ahead):
+                if self.in_flight >= self.workers:
+                    break
+                if not self.is_slider[i] or self.states[i] != RenderState.NONE or object_manager.end_times[i] < offset:
+                    continue
+                if i not in self.bounds:
+                    self.bounds[i] = self.get_bounds(object_manager.hit_objects[i])
+                if i >= end and not self.make_room(self.estimate_size(i), start, end_ahead):
+                    break
+                self.states[i] = RenderState.PENDING
+                self.in_flight += 1
+                future = self.pool.submit(self.render, i)
+                self.pending[future] = i
+                future.add_done_callback(self.on_rendered)
+
+    def estimate_size(self, index):
+        return self.bounds[index][2] * self.bounds[index][3] * 4
+
+    def make_room(self, size, start, end_ahead):
+        """
+        Evict least recently used bodies outside the render-ahead window until `size` more bytes fit.
+        """
+        for i in list(self.surfaces):
+            if self.size + size <= self.max_size:
+                break
+            if start <= i < end_ahead:
+                continue
+            self.size -= get_surface_size(self.surfaces.pop(i))
+            self.states[i] = RenderState.NONE
+        return self.size + size <= self.max_size
 
-    def get_ac_multiplier(self, hit_object, offset):
-        return (hit_object.time - offset) / self.preempt * 2 + 1
+    def render(self, index):
+        # Runs in the worker pool
+        config = self.config
+        resolution = self.resolution
+        hit_object = self.object_manager.hit_objects[index]
+        # Bounds are worked out by dispatch() before a slider is submitted
+        x, y, w, h = self.bounds[index]
+        color = config.combo_colors[self.object_manager.combo_colors[index]] \
+            if config.slider_track_override == SkinOption.CURRENT_COMBO_COLOR \
+            else config.slider_track_color
+        # Rendering with a shifted placement offset draws the body straight into its bounding box
+        hit_object.render((w, h), (resolution.actual_placement_offset[0] - x, resolution.actual_placement_offset[1] - y),
+                          resolution.osu_pixel_multiplier, color, config.slider_border,
+                          round(5*resolution.osu_pixel_multiplier))
+        surf = hit_object.surf
+        hit_object.surf = None
+        return index, surf
 
-    @staticmethod
-    def get_sliderball_position(current_offset, hit_object, resolution):
-        index = min(math.floor((current_offset - hit_object.time) /
-                               (hit_object.end_time - hit_object.time) *
-                               len(hit_object.curve.curve_points)),
-                    len(hit_object.curve.curve_points)-1)
-        return resolution.get_hitcircle_position(hit_object.nested_objects[index])
+    def on_rendered(self, future):
+        with self.lock:
+            self.in_flight -= 1
+            index = self.pending.pop(future)
+            if future.cancelled():
+                self.states[index] = RenderState.NONE
+                return
+            if not self.running:
+                return
+            if future.exception() is not None:
+                print(f"Failed to render slider: {future.exception()}")
+                self.states[index] = RenderState.FAILED
+                self.rendered.notify_all()
+                return
+            _, surf = future.result()
+            self.surfaces[index] = surf
+            self.size += get_surface_size(surf)
+            self.states[index] = RenderState.READY
+            self.rendered.notify_all()
+        self.dispatch()